@@ -1,69 +1,407 @@
+import base64
 import datetime
-import importlib
+import hmac
+import json
+import math
 import os
 import time
-from zoneinfo import ZoneInfo
+from collections import deque
 
 import boto3
 
 import logger
-from aws.gatherings import Gatherings
+from aws.aws_exception import AwsException
+from aws.chat_settings import ChatSettingsStore
+from aws.gathering_ids import GatheringIdAllocator
+from aws.gatherings import Gatherings, SHARD_COUNT
+from aws.lease import Lease, ShardLeases
 from aws.settings import Settings
+from aws.unit_of_work import UnitOfWork
+from aws.wake_up_scheduler import EventBridgeWakeUpScheduler, WakeUpScheduler
+from service.bot_identity import BotIdentity
+from service.edit_coalescer import EditCoalescer
 from service.team_gather_service import TeamGatherService
 from service.time_parser import TimeParser
+from telegram.api.async_telegram_api import AsyncTelegram
+from telegram.api.outbound_scheduler import OutboundScheduler
 from telegram.api.telegram_api import Telegram
 from telegram.api.telegram_exception import TelegramException
+from telegram.model.response.update import Update
 
 
 class Handler:
-    def __init__(self, dynamodb_client, telegram):
+    # the last update time is only refreshed this often not to rewrite the settings on every pass
+    _last_update_time_resolution = 60 * 60
+    # updates received within this many seconds make up the recent update rate
+    _update_rate_window = 5 * 60
+
+    def __init__(self, dynamodb_client, telegram, bot_identity: BotIdentity, async_telegram: AsyncTelegram = None,
+                 edit_coalescer: EditCoalescer = None, wake_up_scheduler: WakeUpScheduler = None,
+                 chat_settings: ChatSettingsStore = None, gathering_ids: GatheringIdAllocator = None, lease: Lease = None,
+                 shard_leases: ShardLeases = None):
         self.dynamodb_client = dynamodb_client
         self.telegram = telegram
+        self.async_telegram = async_telegram
+        # edits are held back across passes and warm invocations
+        self.edit_coalescer = edit_coalescer
+        self.bot_identity = bot_identity
+        self.wake_up_scheduler = wake_up_scheduler if wake_up_scheduler is not None else WakeUpScheduler()
+        # cached between passes and warm invocations, changes are seen after the TTL
+        self.chat_settings = chat_settings
+        # held by the invocation that polls for updates, None when invocations never overlap
+        self.lease = lease
+        # splits time-based events among concurrent tick invocations, None when all of them are handled by one
+        self.shard_leases = shard_leases
 
-    def handle(self):
-        logger.debug("Start")
+        # the state is kept between passes and warm invocations and reloaded only when the stored version changes,
+        # the gatherings written by others are read again one by one
+        self._settings: Settings | None = None
+        self._gatherings: Gatherings | None = None
+        # ids are reserved in blocks, the rest of a block is used by the next passes and warm invocations
+        self._gathering_ids = gathering_ids if gathering_ids is not None else GatheringIdAllocator(dynamodb_client)
+        # receive times of recent updates, one entry per pass with updates
+        self._update_times: deque[tuple[float, int]] = deque()
+
+    def handle(self, poll_timeout: int = 0) -> int:
+        """:return: the number of updates received"""
+
+        count = self._run(lambda service: service.handle_events(poll_timeout))
+        if count > 0:
+            self._update_times.append((time.time(), count))
+        return count
+
+    def next_deadline(self) -> int | None:
+        """:return: the next start or end time of a gathering, None if nothing is scheduled or the state is not loaded"""
+
+        return self._gatherings.next_deadline() if self._gatherings is not None else None
+
+    def update_rate(self) -> float:
+        """:return: updates per second received recently"""
+
+        now = time.time()
+        while len(self._update_times) != 0 and self._update_times[0][0] < now - self._update_rate_window:
+            self._update_times.popleft()
+        return sum(count for _, count in self._update_times) / self._update_rate_window
+
+    def handle_updates(self, updates: list[Update]):
+        self._run(lambda service: service.handle_updates(updates))
+
+    def handle_ticks(self):
+        self._run(lambda service: service.handle_ticks())
+
+    def flush_edits(self):
+        self._run(lambda service: service.flush_edits())
+
+    def handle_shard_ticks(self, shards: list[int]):
+        """Handle time-based events of the gatherings in the shards only
+
+        The state is read on every call, as other workers keep changing it. The settings are not saved.
+        """
+
+        logger.debug(f"Start, shards: {shards}")
 
         settings = Settings(self.dynamodb_client)
-        gatherings = Gatherings(self.dynamodb_client)
+        gatherings = Gatherings(self.dynamodb_client, shards)
+        time_parser = TimeParser.for_timezone(settings.timezone, int(datetime.datetime.now().timestamp()))
 
-        try:
-            i18n = importlib.import_module(f'i18n.{settings.locale}')
-        except ModuleNotFoundError:
-            i18n = importlib.import_module('i18n.en')
+        team_gather_service = TeamGatherService(self.telegram, self.bot_identity, settings, gatherings, time_parser, self._gathering_ids, self.async_telegram, self.edit_coalescer, self.chat_settings)
+        team_gather_service.handle_ticks()
+
+        unit_of_work = UnitOfWork(self.dynamodb_client)
+        if gatherings.write_to(unit_of_work):
+            unit_of_work.flush()
+            gatherings.increase_version()
+
+        logger.debug("End")
+
+    def _run(self, action):
+        logger.debug("Start")
+
+        if self._settings is None or self._settings.read_version() != self._settings.version:
+            logger.debug("Loading settings")
+            self._settings = Settings(self.dynamodb_client)
+        if self._gatherings is None or not self._gatherings.refresh():
+            logger.debug("Loading gatherings")
+            self._gatherings = Gatherings(self.dynamodb_client)
+        settings = self._settings
+        gatherings = self._gatherings
 
-        timezone = ZoneInfo(settings.timezone)
         current_time = int(datetime.datetime.now().timestamp())
-        time_parser = TimeParser(current_time, timezone)
+        time_parser = TimeParser.for_timezone(settings.timezone, current_time)
 
         if settings.last_update_time + 6 * 24 * 60 * 60 < current_time:
             settings.last_update_id = -1
-        settings.last_update_time = current_time
+        if settings.last_update_time + self._last_update_time_resolution < current_time:
+            settings.last_update_time = current_time
 
-        team_gather_service = TeamGatherService(self.telegram, settings, gatherings, i18n, time_parser)
-        team_gather_service.handle_events()
+        try:
+            team_gather_service = TeamGatherService(self.telegram, self.bot_identity, settings, gatherings, time_parser, self._gathering_ids, self.async_telegram, self.edit_coalescer, self.chat_settings)
+            result = action(team_gather_service)
 
-        settings.save()
+            # gathering writes do not depend on the settings, so that invocations writing gatherings at the same time
+            # do not fail each other; the settings with the update offset go last and only when they changed
+            unit_of_work = UnitOfWork(self.dynamodb_client)
+            if gatherings.write_to(unit_of_work):
+                unit_of_work.flush()
+                gatherings.increase_version()
+            if settings.is_changed():
+                settings.write_to(unit_of_work)
+                unit_of_work.flush()
+        except Exception:
+            # the state in memory might be partially applied, it is reloaded on the next pass
+            self._settings = None
+            self._gatherings = None
+            raise
 
         logger.debug("End")
+        return result
+
+
+# kept between warm invocations to reuse the Telegram connection pool
+_handler: Handler | None = None
+
+
+def _get_handler() -> Handler:
+    global _handler
+    if _handler is None:
+        dynamodb_client = boto3.client('dynamodb')
+        telegram_pool_size = int(os.environ.get('TELEGRAM_POOL_SIZE', '10'))
+        telegram = Telegram(
+            os.environ['TELEGRAM_TOKEN'],
+            pool_size=telegram_pool_size,
+            connect_timeout=float(os.environ.get('TELEGRAM_CONNECT_TIMEOUT', '5')),
+            read_timeout=float(os.environ.get('TELEGRAM_READ_TIMEOUT', '10')),
+            retries=int(os.environ.get('TELEGRAM_RETRIES', '3')),
+            scheduler=OutboundScheduler(
+                global_rate=float(os.environ.get('TELEGRAM_GLOBAL_RATE', '30')),
+                group_rate=float(os.environ.get('TELEGRAM_GROUP_RATE', '0.33')),
+                private_rate=float(os.environ.get('TELEGRAM_PRIVATE_RATE', '1')),
+                max_wait=float(os.environ.get('TELEGRAM_MAX_WAIT', '10'))
+            )
+        )
+        bot_identity_ttl = os.environ.get('BOT_IDENTITY_TTL')
+        bot_identity = BotIdentity(
+            telegram,
+            username=os.environ.get('BOT_USERNAME'),
+            ttl=int(bot_identity_ttl) if bot_identity_ttl is not None else None
+        )
+        # commands of different chats are executed concurrently, one connection per chat at most
+        async_telegram = AsyncTelegram(telegram, max_workers=telegram_pool_size) if telegram_pool_size > 1 else None
+        edit_debounce = float(os.environ.get('EDIT_DEBOUNCE', '1'))
+        edit_coalescer = EditCoalescer(edit_debounce) if edit_debounce > 0 else None
+        wake_up_schedule_name = os.environ.get('WAKE_UP_SCHEDULE_NAME')
+        wake_up_scheduler = EventBridgeWakeUpScheduler(
+            boto3.client('scheduler'),
+            wake_up_schedule_name,
+            os.environ['WAKE_UP_TARGET_ARN'],
+            os.environ['WAKE_UP_ROLE_ARN'],
+            os.environ.get('WAKE_UP_SCHEDULE_GROUP', 'default')
+        ) if wake_up_schedule_name is not None else WakeUpScheduler()
+        chat_settings = ChatSettingsStore(
+            dynamodb_client,
+            max_size=int(os.environ.get('CHAT_SETTINGS_CACHE_SIZE', '1024')),
+            ttl=float(os.environ.get('CHAT_SETTINGS_TTL', '300'))
+        )
+        gathering_ids = GatheringIdAllocator(dynamodb_client, block_size=int(os.environ.get('GATHERING_ID_BLOCK_SIZE', '20')))
+        lease_duration = int(os.environ.get('LEASE_DURATION', '60'))
+        lease = Lease(dynamodb_client, 'polling', lease_duration) if lease_duration > 0 else None
+        shard_lease_duration = int(os.environ.get('SHARD_LEASE_DURATION', '0'))
+        shard_leases = ShardLeases(dynamodb_client, 'ticks', SHARD_COUNT, shard_lease_duration) if shard_lease_duration > 0 else None
+        _handler = Handler(dynamodb_client, telegram, bot_identity, async_telegram, edit_coalescer, wake_up_scheduler, chat_settings,
+                           gathering_ids, lease, shard_leases)
+    return _handler
 
 
 def handler(event, context):
+    """Poll Telegram for updates and handle time-based events, to be invoked on a schedule
+
+    The function polls as long as updates keep coming or a gathering starts or ends before the time is up,
+    and stops early when it is quiet. Before returning it asks the wake up scheduler for the next invocation:
+    at the next start or end time, or after a sleep that grows as the recent update rate drops.
+    The fixed schedule is then only a fallback and can be infrequent.
+
+    Only one invocation polls at a time, the one holding the lease. Another invocation exits at once,
+    or waits up to LEASE_WAIT seconds to take over, so invocations can overlap without handling updates twice.
+    The lease is renewed between long polling requests, LEASE_DURATION has to be well over twice
+    LONG_POLLING_TIMEOUT + TIME_RESERVE.
+    """
+
     logger.set_logging_level(os.environ.get('LOGGING_LEVEL', 'INFO'))
 
-    dynamodb_client = boto3.client('dynamodb')
-    telegram = Telegram(os.environ['TELEGRAM_TOKEN'])
-    handler = Handler(dynamodb_client, telegram)
+    handler = _get_handler()
 
     execution_timeout = int(os.environ.get('EXECUTION_TIMEOUT', '1'))
-    time_between_invocations = int(os.environ.get('TIME_BETWEEN_INVOCATIONS', '2'))
+    long_polling_timeout = int(os.environ.get('LONG_POLLING_TIMEOUT', '10'))
+    # polling stops after this many seconds when no updates were received recently
+    idle_timeout = int(os.environ.get('IDLE_TIMEOUT', '1'))
+    # bounds of the time until the next invocation requested when nothing is due
+    min_sleep = int(os.environ.get('MIN_SLEEP', '60'))
+    max_sleep = int(os.environ.get('MAX_SLEEP', '600'))
+    # time reserved for sending messages and saving the state after the last long polling request returns
+    time_reserve = int(os.environ.get('TIME_RESERVE', '3'))
+    # sleep after a failed pass, doubled with every further failure in a row
+    error_backoff = float(os.environ.get('ERROR_BACKOFF', '2'))
     time_start = time.time()
-    while time.time() - time_start < execution_timeout:
+    time_end = time_start + min(execution_timeout, context.get_remaining_time_in_millis() / 1000 - time_reserve)
+
+    lease = handler.lease
+    if lease is not None:
+        lease_wait = int(os.environ.get('LEASE_WAIT', '0'))
+        try:
+            if not _acquire_lease(lease, min(time_end, time_start + lease_wait)):
+                logger.info("Another invocation is polling, exiting")
+                return
+        except AwsException as e:
+            logger.error(str(e))
+            return
+
+    # the held back edits are still sent when the lease is lost, only the release is skipped
+    lease_lost = False
+    try:
+        failures = 0
+        while True:
+            now = time.time()
+            time_left = int(time_end - now)
+            poll_timeout = min(time_left, long_polling_timeout)
+            # wake up when the next gathering is due, it is handled right after getUpdates returns
+            next_deadline = handler.next_deadline()
+            if next_deadline is not None and next_deadline <= time_end:
+                poll_timeout = min(poll_timeout, math.ceil(next_deadline - now))
+            try:
+                if lease is not None and not lease.heartbeat():
+                    logger.warn("Lease taken over by another invocation, stopping")
+                    lease_lost = True
+                    break
+                handler.handle(max(poll_timeout, 0))
+                failures = 0
+            except TelegramException as e:
+                logger.error(str(e))
+                handler.bot_identity.on_error(e)
+                failures += 1
+            except AwsException as e:
+                logger.error(str(e))
+                failures += 1
+
+            if time_left <= 0:
+                break
+            if failures > 0:
+                # not to retry a failing getUpdates or DynamoDB call right away until the time is up
+                backoff = min(error_backoff * 2 ** (failures - 1), time_end - time.time())
+                if backoff > 0:
+                    logger.debug(f"Retrying after {backoff:.1f} s")
+                    time.sleep(backoff)
+            next_deadline = handler.next_deadline()
+            if handler.update_rate() == 0 and time.time() - time_start >= idle_timeout \
+                    and (next_deadline is None or next_deadline > time_end):
+                logger.debug("Quiet, stopping early")
+                break
+    finally:
+        # the process may be suspended after returning, this also runs when the loop failed unexpectedly
         try:
-            handler.handle()
+            handler.flush_edits()
         except TelegramException as e:
             logger.error(str(e))
+            handler.bot_identity.on_error(e)
+        except AwsException as e:
+            logger.error(str(e))
+        finally:
+            # a waiting invocation takes over right away
+            if lease is not None and not lease_lost:
+                try:
+                    lease.release()
+                except AwsException as e:
+                    logger.error(str(e))
+
+    # the expected time until the next update, the sooner the busier the chats are
+    update_rate = handler.update_rate()
+    sleep = min(max_sleep, max(min_sleep, 1 / update_rate)) if update_rate > 0 else max_sleep
+    wake_up_time = int(time.time() + sleep)
+    next_deadline = handler.next_deadline()
+    if next_deadline is not None:
+        wake_up_time = min(wake_up_time, next_deadline)
+    try:
+        handler.wake_up_scheduler.schedule(wake_up_time)
+    except AwsException as e:
+        logger.error(str(e))
+
+
+def _acquire_lease(lease: Lease, until: float, retry_interval: float = 1) -> bool:
+    """:return: whether the lease was acquired before the time given, it is retried until then"""
+
+    while not lease.acquire():
+        if time.time() + retry_interval > until:
+            return False
+        time.sleep(retry_interval)
+    return True
+
+
+def webhook_handler(event, context):
+    """Handle an update pushed by Telegram to a webhook (Lambda function URL or API Gateway proxy event)
+
+    The webhook is expected to be set with max_connections=1, so that updates arrive in order,
+    and with the secret token from the TELEGRAM_WEBHOOK_SECRET environment variable.
+    Time-based events are handled by tick_handler.
+    """
+
+    logger.set_logging_level(os.environ.get('LOGGING_LEVEL', 'INFO'))
+
+    # without a secret every call is rejected, an unset variable must not let any caller in
+    webhook_secret = os.environ.get('TELEGRAM_WEBHOOK_SECRET')
+    if not webhook_secret:
+        logger.error("TELEGRAM_WEBHOOK_SECRET is not set, webhook calls are rejected")
+        return {'statusCode': 403}
+
+    headers = {k.lower(): v for k, v in (event.get('headers') or {}).items()}
+    secret_token = headers.get('x-telegram-bot-api-secret-token', '')
+    if not hmac.compare_digest(secret_token.encode(), webhook_secret.encode()):
+        logger.warn("Webhook called with an invalid secret token")
+        return {'statusCode': 403}
+
+    body = event.get('body') or '{}'
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body).decode()
+    update = Update(json.loads(body))
+
+    handler = _get_handler()
+    # errors are not reported back, Telegram would redeliver the update over and over again
+    try:
+        handler.handle_updates([update])
+    except TelegramException as e:
+        logger.error(str(e))
+        handler.bot_identity.on_error(e)
+    except AwsException as e:
+        logger.error(str(e))
+
+    return {'statusCode': 200}
+
+
+def tick_handler(event, context):
+    """Handle time-based events only, to be invoked on a schedule when updates are received by webhook_handler
+
+    With SHARD_LEASE_DURATION set, several invocations can run at the same time, each one handling the gatherings
+    of the shards it holds leases of while it runs; the duration, for which a worker counts as alive,
+    has to be longer than the time between two invocations.
+    """
+
+    logger.set_logging_level(os.environ.get('LOGGING_LEVEL', 'INFO'))
 
-        if time.time() - time_start < execution_timeout - time_between_invocations:
-            time.sleep(time_between_invocations)
+    handler = _get_handler()
+    try:
+        if handler.shard_leases is None:
+            handler.handle_ticks()
         else:
-            break
+            # the leases expire when the invocation ends at the latest
+            until = time.time() + context.get_remaining_time_in_millis() / 1000
+            # the assigned shards first, then the ones left by workers that are late or gone
+            for others in (False, True):
+                shards = handler.shard_leases.acquire(until, others)
+                try:
+                    if len(shards) != 0:
+                        handler.handle_shard_ticks(shards)
+                finally:
+                    handler.shard_leases.release(shards)
+    except TelegramException as e:
+        logger.error(str(e))
+        handler.bot_identity.on_error(e)
+    except AwsException as e:
+        logger.error(str(e))
@@ -0,0 +1,98 @@
+import collections
+import time
+
+import logger
+from .aws_exception import AwsException
+from .dynamodb_document import _Codec, _DynamodbDocument, STRING
+
+
+class ChatSettings(_DynamodbDocument):
+    """Settings of a chat, unset values fall back to the global settings"""
+
+    __slots__ = ('chat_id', 'timezone', 'locale')
+    _codec = _Codec([
+        ('chat_id', 'chat_id', STRING),
+        ('timezone', 'timezone', STRING),
+        ('locale', 'locale', STRING),
+    ])
+
+    def __init__(self):
+        self.chat_id = None
+        self.timezone = None
+        self.locale = None
+
+    def __repr__(self) -> str:
+        return f'ChatSettings(chat_id={self.chat_id}, timezone={self.timezone}, locale={self.locale})'
+
+
+class ChatSettingsStore:
+    """Reads chat settings in bulk and keeps them in a bounded LRU cache with a TTL
+
+    The table has 'chat_id' (S) as the partition key. Chats without an item are cached too, as having no settings.
+
+    :parameter max_size: the maximum number of cached chats
+    :parameter ttl: seconds a cached entry is used for, changes made in the table are seen after that time
+    """
+
+    _table_name = 'team_gather_bot.chat_settings'
+    _batch_get_max_keys = 100
+
+    def __init__(self, dynamodb_client, max_size: int = 1024, ttl: float = 300, max_attempts: int = 5, backoff: float = 0.05):
+        self._dynamodb_client = dynamodb_client
+        self._max_size = max_size
+        self._ttl = ttl
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        # chat_id -> (expiration time, settings or None), least recently used first
+        self._cache: collections.OrderedDict[str, tuple[float, ChatSettings | None]] = collections.OrderedDict()
+
+    def prefetch(self, chat_ids):
+        """Read the settings of the chats that are not cached, in as few calls as possible"""
+
+        now = time.monotonic()
+        missing = [chat_id for chat_id in set(chat_ids) if self._get_cached(chat_id, now) is None]
+        for i in range(0, len(missing), self._batch_get_max_keys):
+            self._read(missing[i:i + self._batch_get_max_keys], now)
+
+    def get(self, chat_id: str) -> ChatSettings | None:
+        """:return: the settings of the chat, None if the chat has no settings of its own"""
+
+        now = time.monotonic()
+        entry = self._get_cached(chat_id, now)
+        if entry is None:
+            return self._read([chat_id], now)[chat_id]
+        return entry[1]
+
+    def _get_cached(self, chat_id: str, now: float) -> tuple[float, ChatSettings | None] | None:
+        entry = self._cache.get(chat_id)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._cache[chat_id]
+            return None
+        self._cache.move_to_end(chat_id)
+        return entry
+
+    def _read(self, chat_ids: list[str], now: float) -> dict[str, ChatSettings | None]:
+        settings_by_chat: dict[str, ChatSettings | None] = {chat_id: None for chat_id in chat_ids}
+        request_items = {self._table_name: {'Keys': [{'chat_id': STRING.encode(chat_id)} for chat_id in chat_ids]}}
+        for attempt in range(self._max_attempts):
+            if attempt > 0:
+                time.sleep(self._backoff * 2 ** (attempt - 1))
+            result = self._dynamodb_client.batch_get_item(RequestItems=request_items)
+            logger.debug(f"Chat settings read, dynamodb result: {result}")
+            for chat_settings in ChatSettings.from_dynamodb_items(result['Responses'].get(self._table_name, [])):
+                settings_by_chat[chat_settings.chat_id] = chat_settings
+            request_items = result.get('UnprocessedKeys')
+            if not request_items:
+                break
+        else:
+            raise AwsException(f"Chat settings not read after {self._max_attempts} attempts: {request_items}")
+
+        expiration = now + self._ttl
+        for chat_id, chat_settings in settings_by_chat.items():
+            self._cache[chat_id] = (expiration, chat_settings)
+            self._cache.move_to_end(chat_id)
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+        return settings_by_chat
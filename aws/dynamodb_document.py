@@ -1,45 +1,181 @@
+import itertools
+
+
+class _Type:
+    """Conversion of values of one type from and to DynamoDB JSON
+
+    A type is given as Python expressions that convert the value of a variable, so that codecs
+    can inline them into the code generated for a document class.
+    Absent attributes are decoded from None; encoding to None means the attribute has to be omitted (empty sets).
+
+    :parameter encode_source: function of a variable name returning the encoding expression
+    :parameter decode_source: function of a variable name returning the decoding expression
+    :parameter omittable: whether the encoding expression may be None
+    """
+
+    __slots__ = ('encode_source', 'decode_source', 'omittable', 'encode', 'decode')
+
+    def __init__(self, encode_source, decode_source, omittable: bool = False):
+        self.encode_source = encode_source
+        self.decode_source = decode_source
+        self.omittable = omittable
+        self.encode = eval(f'lambda v: {encode_source("v")}')
+        self.decode = eval(f'lambda v: {decode_source("v")}')
+
+
+STRING = _Type(
+    lambda v: f"({{'S': {v}}} if {v} is not None else {{'NULL': True}})",
+    lambda v: f"({v}.get('S') if {v} is not None else None)"
+)
+NUMBER = _Type(
+    lambda v: f"({{'N': str({v})}} if {v} is not None else {{'NULL': True}})",
+    lambda v: f"(int({v}['N']) if {v} is not None and 'N' in {v} else None)"
+)
+BOOL = _Type(
+    lambda v: f"({{'BOOL': {v}}} if {v} is not None else {{'NULL': True}})",
+    lambda v: f"({v}.get('BOOL') if {v} is not None else None)"
+)
+# DynamoDB does not store empty sets, the attribute has to be omitted instead
+STRING_SET = _Type(
+    lambda v: f"({{'SS': sorted({v})}} if {v} else None)",
+    lambda v: f"(set({v}['SS']) if {v} is not None and 'SS' in {v} else set())",
+    omittable=True
+)
+NUMBER_SET = _Type(
+    lambda v: f"({{'NS': [str(n) for n in sorted({v})]}} if {v} else None)",
+    lambda v: f"({{int(n) for n in {v}['NS']}} if {v} is not None and 'NS' in {v} else set())",
+    omittable=True
+)
+
+# suffixes of the variables of generated comprehensions, unique for nested types
+_variable_ids = itertools.count()
+
+
+def map_of(value_type: _Type) -> _Type:
+    """:return: type of maps (M) with values of the given type, absent maps are decoded as empty"""
+
+    assert not value_type.omittable
+    i = next(_variable_ids)
+    return _Type(
+        lambda v: f"({{'M': {{k{i}: {value_type.encode_source(f'x{i}')} for k{i}, x{i} in {v}.items()}}}} if {v} is not None else {{'NULL': True}})",
+        lambda v: f"({{k{i}: {value_type.decode_source(f'x{i}')} for k{i}, x{i} in {v}['M'].items()}} if {v} is not None and 'M' in {v} else {{}})"
+    )
+
+
+def list_of(value_type: _Type) -> _Type:
+    """:return: type of lists (L) with values of the given type, absent lists are decoded as empty"""
+
+    assert not value_type.omittable
+    i = next(_variable_ids)
+    return _Type(
+        lambda v: f"({{'L': [{value_type.encode_source(f'x{i}')} for x{i} in {v}]}} if {v} is not None else {{'NULL': True}})",
+        lambda v: f"([{value_type.decode_source(f'x{i}')} for x{i} in {v}['L']] if {v} is not None and 'L' in {v} else [])"
+    )
+
+
+class _Codec:
+    """Converts documents from and to DynamoDB items according to a field schema
+
+    The schema is a list of (field, path, type): the document attribute, the item attribute
+    (or 'map.attribute' for an attribute of a top-level map) and the _Type of the value.
+    The conversion functions are generated once, when the codec is created, with the conversions
+    of all the fields inlined.
+    """
+
+    def __init__(self, schema: list[tuple[str, str, _Type]]):
+        # item attribute -> [(field, map attribute or None, type)]
+        attributes: dict[str, list[tuple[str, str | None, _Type]]] = {}
+        for field, path, field_type in schema:
+            assert field.isidentifier()
+            attribute, _, sub_attribute = path.partition('.')
+            attributes.setdefault(attribute, []).append((field, sub_attribute or None, field_type))
+
+        encode_lines = ['def encode(document):', '    item = {}']
+        decode_lines = ['def decode(item, document):', '    get = item.get']
+        for attribute, fields in attributes.items():
+            if fields[0][1] is None:
+                field, _, field_type = fields[0]
+                encode_lines += self._encode_lines('item', attribute, field, field_type)
+                decode_lines += [f'    v = get({attribute!r})', f'    document.{field} = {field_type.decode_source("v")}']
+            else:
+                encode_lines.append('    m = {}')
+                decode_lines += [f'    m = get({attribute!r})', "    m = m['M'] if m is not None and 'M' in m else {}"]
+                for field, sub_attribute, field_type in fields:
+                    encode_lines += self._encode_lines('m', sub_attribute, field, field_type)
+                    decode_lines += [f'    v = m.get({sub_attribute!r})', f'    document.{field} = {field_type.decode_source("v")}']
+                encode_lines.append(f"    item[{attribute!r}] = {{'M': m}}")
+        encode_lines.append('    return item')
+        decode_lines.append('    return document')
+
+        namespace = {}
+        exec('\n'.join(encode_lines + decode_lines), namespace)
+        self.encode = namespace['encode']
+        self.decode = namespace['decode']
+
+    @staticmethod
+    def _encode_lines(target: str, attribute: str, field: str, field_type: _Type) -> list[str]:
+        lines = [f'    v = document.{field}']
+        if field_type.omittable:
+            lines += [f'    v = {field_type.encode_source("v")}', '    if v is not None:', f'        {target}[{attribute!r}] = v']
+        else:
+            lines.append(f'    {target}[{attribute!r}] = {field_type.encode_source("v")}')
+        return lines
+
+
 class _DynamodbDocument:
+    # subclasses may declare __slots__
+    __slots__ = ()
+    # conversion according to the fields of the subclass
+    _codec: _Codec = None
+
     def to_dynamodb_json(self) -> dict:
-        return None
-
-    def _to_dynamodb_json(self, value) -> dict:
-        if value is None:
-            return {'NULL': True}
-        elif isinstance(value, bool):
-            return {'BOOL': value}
-        elif isinstance(value, str):
-            return {'S': value}
-        elif isinstance(value, int):
-            return {'N': str(value)}
-        elif isinstance(value, list) or isinstance(value, set):
-            return {'L': list(map(lambda v: self._to_dynamodb_json(v), value))}
-        elif isinstance(value, dict):
-            return {'M': {k: self._to_dynamodb_json(v) for k, v in value.items()}}
-        else:
-            return {'S': str(value)}
+        return self._codec.encode(self)
 
     def from_dynamodb_json(self, dynamodb_json: dict):
-        return None
+        return self._codec.decode(dynamodb_json, self)
+
+    @classmethod
+    def from_dynamodb_items(cls, dynamodb_json_items: list[dict]) -> list:
+        """Decode a page of items, the documents are created without calling __init__"""
+
+        new = cls.__new__
+        return [new(cls).from_dynamodb_json(item) for item in dynamodb_json_items]
+
+
+class _UpdateExpression:
+    """Builder of UpdateItem arguments, attribute paths are given as lists of attribute names"""
 
-    def _from_dynamodb_json(self, dynamodb_json: dict):
-        value = dynamodb_json.get('BOOL')
-        if value is not None:
-            return value.upper() == 'TRUE'
+    def __init__(self):
+        self._names: dict[str, str] = {}
+        self._values: dict[str, dict] = {}
+        self._actions: dict[str, list[str]] = {'SET': [], 'REMOVE': []}
 
-        value = dynamodb_json.get('S')
-        if value is not None:
-            return value
+    def set(self, path: list[str], value: dict):
+        self._actions['SET'].append(f'{self._path(path)} = {self._value(value)}')
+        return self
 
-        value = dynamodb_json.get('N')
-        if value is not None:
-            return int(value)
+    def remove(self, path: list[str]):
+        self._actions['REMOVE'].append(self._path(path))
+        return self
 
-        value = dynamodb_json.get('L')
-        if value is not None:
-            return map(lambda v: self._from_dynamodb_json(v), value)
+    def to_arguments(self) -> dict:
+        arguments = {
+            'UpdateExpression': ' '.join(f'{action} {", ".join(clauses)}' for action, clauses in self._actions.items() if clauses),
+            'ExpressionAttributeNames': self._names,
+        }
+        if self._values:
+            arguments['ExpressionAttributeValues'] = self._values
+        return arguments
 
-        value = dynamodb_json.get('M')
-        if value is not None:
-            return {k: self._from_dynamodb_json(v) for k, v in value.items()}
+    def _path(self, path: list[str]) -> str:
+        placeholders = []
+        for name in path:
+            placeholder = f'#n{len(self._names)}'
+            self._names[placeholder] = name
+            placeholders.append(placeholder)
+        return '.'.join(placeholders)
 
-        return None
+    def _value(self, value: dict) -> str:
+        placeholder = f':v{len(self._values)}'
+        self._values[placeholder] = value
+        return placeholder
@@ -0,0 +1,49 @@
+import threading
+
+import logger
+from .dynamodb_document import NUMBER, STRING
+
+
+class GatheringIdAllocator:
+    """Hands out unique gathering ids from blocks reserved with an atomic counter update
+
+    The counter is an item of the settings table, it is only written when a block is used up,
+    so concurrent processes do not contend for it on every new gathering.
+    Ids of a block that is not used up (e.g. when a process ends) are skipped.
+
+    :parameter block_size: the number of ids reserved at once
+    """
+
+    _table_name = 'team_gather_bot.settings'
+    _entry_id = 'gathering_id'
+
+    def __init__(self, dynamodb_client, block_size: int = 20):
+        self._dynamodb_client = dynamodb_client
+        self._block_size = block_size
+        # the last id handed out and the last id of the reserved block
+        self._next = 0
+        self._end = 0
+        self._lock = threading.Lock()
+
+    def next_id(self, seed: int) -> str:
+        """:parameter seed: the last id allocated before the counter was introduced, used if there is no counter yet"""
+
+        with self._lock:
+            if self._next >= self._end:
+                self._reserve(seed)
+            self._next += 1
+            return str(self._next)
+
+    def _reserve(self, seed: int):
+        result = self._dynamodb_client.update_item(
+            TableName=self._table_name,
+            Key={'id': STRING.encode(self._entry_id)},
+            UpdateExpression='SET #value = if_not_exists(#value, :seed) + :block_size',
+            ExpressionAttributeNames={'#value': 'value'},
+            ExpressionAttributeValues={':seed': NUMBER.encode(seed), ':block_size': NUMBER.encode(self._block_size)},
+            ReturnValues='UPDATED_NEW'
+        )
+        logger.debug(f"Gathering ids reserved, dynamodb result: {result}")
+
+        self._end = NUMBER.decode(result['Attributes']['value'])
+        self._next = self._end - self._block_size
@@ -1,132 +1,587 @@
+import zlib
+
 import logger
 from aws.aws_exception import AwsException
-from aws.dynamodb_document import _DynamodbDocument
+from aws.dynamodb_document import _Codec, _DynamodbDocument, _UpdateExpression, STRING, NUMBER, BOOL, STRING_SET, list_of, map_of
+from aws.unit_of_work import UnitOfWork
+from model.deadline_queue import DeadlineQueue
 
 STATE_SCHEDULED = 0
 STATE_STARTED = 1
 STATE_STOPPED = 2
 
+VOTE_YES = 1
+VOTE_MAYBE = 2
+VOTE_NO = 3
+
+# user ids are numeric, so a prefixed name cannot clash with them
+LEGACY_KEY_PREFIX = 'name:'
+
+# gatherings are partitioned by chat for time-based events to be handled by several workers;
+# the shard is stored with every gathering, so the count cannot be changed without rewriting them all
+SHARD_COUNT = 64
+
+
+def shard_of(chat_id: str) -> int:
+    return zlib.crc32(chat_id.encode()) % SHARD_COUNT
+
+
+_legacy_participants_type = map_of(list_of(STRING))
+
+# scalar fields of a gathering: (field, item path, type); each field is stored in a slot named with an underscore
+# and has a property that marks it as changed
+_fields = [
+    ('id', 'id', STRING),
+    ('chat_id', 'chat_id', STRING),
+    # shard_of(chat_id), set when the gathering is saved
+    ('shard', 'shard', NUMBER),
+    ('message_id', 'message_id', NUMBER),
+    ('state', 'state', NUMBER),
+    ('start', 'start', NUMBER),
+    ('end', 'end', NUMBER),
+    ('max_count', 'max_count', NUMBER),
+    ('message_text', 'message.text', STRING),
+    ('message_what', 'message.what', STRING),
+    ('message_where', 'message.where', STRING),
+    ('message_when', 'message.when', STRING),
+    # fingerprint of the content shown in the message
+    ('message_hash', 'message.hash', STRING),
+]
+
+
+def _tracked_property(slot: str, bit: int) -> property:
+    def get(gathering):
+        return getattr(gathering, slot)
+
+    def set(gathering, value):
+        if value != getattr(gathering, slot):
+            setattr(gathering, slot, value)
+            gathering._changed_fields |= bit
+
+    return property(get, set)
+
 
 class Gathering(_DynamodbDocument):
+    """A gathering, tracking its changes since it was read or saved
+
+    The scalar fields are properties, votes are changed with vote() and unvote() only.
+    """
+
+    __slots__ = tuple('_' + field for field, _, _ in _fields) + ('_votes', '_names', '_changed_fields', '_changed_keys')
+    _codec = _Codec([('_' + field, path, field_type) for field, path, field_type in _fields] + [
+        ('_votes', 'votes', map_of(NUMBER)),
+        ('_names', 'names', map_of(STRING)),
+    ])
+
     def __init__(self):
-        self.id = None
-        self.chat_id = None
-        self.message_id = None
-        self.state = None
-        self.start = None
-        self.end = None
-        self.max_count = None
-        self.participants_yes: set[str] = set()
-        self.participants_maybe: set[str] = set()
-        self.participants_no: set[str] = set()
-        self.message_text = None
-        self.message_what = None
-        self.message_where = None
-        self.message_when = None
-
-    def to_dynamodb_json(self) -> dict:
-        return {
-            'id': self._to_dynamodb_json(self.id),
-            'chat_id': self._to_dynamodb_json(self.chat_id),
-            'message_id': self._to_dynamodb_json(self.message_id),
-            'state': self._to_dynamodb_json(self.state),
-            'start': self._to_dynamodb_json(self.start),
-            'end': self._to_dynamodb_json(self.end),
-            'max_count': self._to_dynamodb_json(self.max_count),
-            'participants': self._to_dynamodb_json({
-                'yes': self.participants_yes,
-                'maybe': self.participants_maybe,
-                'no': self.participants_no,
-            }),
-            'message': self._to_dynamodb_json({
-                'text': self.message_text,
-                'what': self.message_what,
-                'where': self.message_where,
-                'when': self.message_when,
-            }),
-        }
+        for field, _, _ in _fields:
+            setattr(self, '_' + field, None)
+        # participant key -> VOTE_*; the key is the Telegram user id
+        # or, for participants migrated from the name-keyed format, the display name with LEGACY_KEY_PREFIX
+        self._votes: dict[str, int] = dict()
+        # participant key -> display name
+        self._names: dict[str, str] = dict()
+        # bits of the changed fields, by their index in _fields
+        self._changed_fields = 0
+        # participant keys with changed votes or names
+        self._changed_keys: set[str] | None = None
 
-    def from_dynamodb_json(self, dynamodb_json: dict):
-        self.id = self._from_dynamodb_json(dynamodb_json['id'])
-        self.chat_id = self._from_dynamodb_json(dynamodb_json['chat_id'])
-        self.message_id = self._from_dynamodb_json(dynamodb_json['message_id'])
-        self.state = self._from_dynamodb_json(dynamodb_json['state'])
-        self.start = self._from_dynamodb_json(dynamodb_json['start'])
-        self.end = self._from_dynamodb_json(dynamodb_json['end'])
-        self.max_count = self._from_dynamodb_json(dynamodb_json['max_count'])
-
-        participants = self._from_dynamodb_json(dynamodb_json['participants'])
-        self.participants_yes = set(participants['yes'])
-        self.participants_maybe = set(participants['maybe'])
-        self.participants_no = set(participants['no'])
-
-        messages = self._from_dynamodb_json(dynamodb_json['message'])
-        self.message_text = messages.get('text')
-        self.message_what = messages.get('what')
-        self.message_where = messages.get('where')
-        self.message_when = messages.get('when')
+    @property
+    def votes(self) -> dict[str, int]:
+        return self._votes
+
+    @property
+    def names(self) -> dict[str, str]:
+        return self._names
+
+    def vote(self, user_id: str, name: str, vote: int) -> bool:
+        """Set the vote of a participant
+
+        :return: whether the vote or the name changed
+        """
+
+        self._migrate_legacy_key(user_id, name)
+        if self._votes.get(user_id) == vote and self._names.get(user_id) == name:
+            return False
+        self._votes[user_id] = vote
+        self._names[user_id] = name
+        self._change_key(user_id)
+        return True
+
+    def unvote(self, user_id: str, name: str) -> bool:
+        """Remove a participant
+
+        :return: whether the participant had voted
+        """
 
+        self._migrate_legacy_key(user_id, name)
+        if user_id not in self._votes:
+            return False
+        del self._votes[user_id]
+        del self._names[user_id]
+        self._change_key(user_id)
+        return True
+
+    def _migrate_legacy_key(self, user_id: str, name: str):
+        # participants stored by name get the user id on their next vote
+        legacy_key = LEGACY_KEY_PREFIX + name
+        vote = self._votes.pop(legacy_key, None)
+        if vote is None:
+            return
+        del self._names[legacy_key]
+        self._change_key(legacy_key)
+        if user_id not in self._votes:
+            self._votes[user_id] = vote
+            self._names[user_id] = name
+            self._change_key(user_id)
+
+    def _change_key(self, key: str):
+        if self._changed_keys is None:
+            self._changed_keys = set()
+        self._changed_keys.add(key)
+
+    def get_vote(self, user_id: str) -> int | None:
+        return self._votes.get(user_id)
+
+    def count(self, vote: int) -> int:
+        return sum(1 for v in self._votes.values() if v == vote)
+
+    def participants(self, vote: int) -> list[str]:
+        """:return: display names of the participants with the vote"""
+
+        return [self._names[key] for key, v in self._votes.items() if v == vote]
+
+    def is_changed(self) -> bool:
+        return self._changed_fields != 0 or self._changed_keys is not None
+
+    def to_dynamodb_update(self) -> _UpdateExpression:
+        """:return: the update of the stored item with the changes since it was read or saved"""
+
+        update = _UpdateExpression()
+
+        changed_fields = self._changed_fields
+        for i, (field, path, field_type) in enumerate(_fields):
+            if changed_fields & (1 << i):
+                update.set(path.split('.'), field_type.encode(getattr(self, '_' + field)))
+
+        for key in self._changed_keys or ():
+            vote = self._votes.get(key)
+            if vote is not None:
+                update.set(['votes', key], NUMBER.encode(vote))
+                update.set(['names', key], STRING.encode(self._names[key]))
+            else:
+                update.remove(['votes', key])
+                update.remove(['names', key])
+
+        return update
+
+    def reset_changes(self):
+        self._changed_fields = 0
+        self._changed_keys = None
+
+    def from_dynamodb_json(self, dynamodb_json: dict):
+        self._codec.decode(dynamodb_json, self)
+        if 'votes' not in dynamodb_json:
+            self._from_legacy_participants(dynamodb_json)
+        self.reset_changes()
         return self
 
+    def _from_legacy_participants(self, dynamodb_json: dict):
+        if 'participants' in dynamodb_json:
+            # a map of lists of names
+            participants = _legacy_participants_type.decode(dynamodb_json['participants'])
+            by_vote = [(VOTE_YES, participants['yes']), (VOTE_MAYBE, participants['maybe']), (VOTE_NO, participants['no'])]
+        else:
+            # string sets of names
+            by_vote = [(vote, STRING_SET.decode(dynamodb_json.get(attribute)))
+                       for vote, attribute in [(VOTE_YES, 'participants_yes'), (VOTE_MAYBE, 'participants_maybe'), (VOTE_NO, 'participants_no')]]
+
+        self._votes = dict()
+        self._names = dict()
+        for vote, names in by_vote:
+            for name in names:
+                # a name in several lists is counted once, with the first vote
+                key = LEGACY_KEY_PREFIX + name
+                if key not in self._votes:
+                    self._votes[key] = vote
+                    self._names[key] = name
+
     def __repr__(self) -> str:
-        return str(self.__dict__)
+        return str({**{field: getattr(self, '_' + field) for field, _, _ in _fields}, 'votes': self._votes, 'names': self._names})
+
+
+for _i, (_field, _, _) in enumerate(_fields):
+    setattr(Gathering, _field, _tracked_property('_' + _field, 1 << _i))
+del _i, _field
+
+
+class _GatheringsVersion(_DynamodbDocument):
+    """The version item of the gatherings, increased after every write of gatherings"""
+
+    __slots__ = ('value', 'changes', 'pruned', 'sharded')
+    _codec = _Codec([
+        ('value', 'value', NUMBER),
+        # gathering id -> the version of its last write, for the recent versions only
+        ('changes', 'changes', map_of(NUMBER)),
+        # the last version with changes dropped from them
+        ('pruned', 'pruned', NUMBER),
+        # whether every gathering has a shard, the ones saved before did not
+        ('sharded', 'sharded', BOOL),
+    ])
 
 
 class Gatherings:
+    """Active gatherings, all of them or the ones of some shards only
+
+    The gatherings are queried with a global secondary index, which might not show the latest writes yet.
+    The ids written by every version are recorded with it, so that the recently written gatherings are read again
+    consistently from the table.
+
+    :parameter shards: the shards to read, all the gatherings are read if None
+    """
+
     _table_name = 'team_gather_bot.gatherings'
+    # global secondary index with 'state' (N) as the partition key and all attributes projected
+    _state_index_name = 'state-index'
+    # global secondary index with 'state' (N) as the partition key, 'shard' (N) as the sort key and all attributes projected
+    _state_shard_index_name = 'state-shard-index'
+    _active_states = [STATE_SCHEDULED, STATE_STARTED]
+    # an item of the settings table increased after gatherings are written, for other invocations to reload them
+    _version_table_name = 'team_gather_bot.settings'
+    _version_entry_id = 'gatherings_version'
+    # changes of this many versions are kept with the version, older writes are expected to be in the index
+    _versions_kept = 100
+    _batch_get_max_keys = 100
+    # a single version update records this many ids at most, to keep within the expression size limit
+    _version_max_ids = 50
 
-    def __init__(self, dynamodb_client):
+    def __init__(self, dynamodb_client, shards: list[int] = None):
         self._dynamodb_client = dynamodb_client
+        self._shards = set(shards) if shards is not None else None
 
-        result = self._dynamodb_client.scan(
-            TableName=self._table_name,
-            FilterExpression='#state <> :state',
-            ExpressionAttributeNames={'#state': 'state'},
-            ExpressionAttributeValues={':state': _DynamodbDocument._to_dynamodb_json(_DynamodbDocument(), STATE_STOPPED)}
-        )
-        logger.debug(f"Gatherings read, dynamodb result: {result}")
+        # read first, so that gatherings written while they are queried are reloaded later
+        version = self._read_version()
+        self.version = version.value
 
-        self.gatherings: dict[str, Gathering] = self._from_dynamodb_json(result)
-        self._gatherings_original: dict[str, Gathering] = self._from_dynamodb_json(result)
+        items = []
+        for state in self._active_states:
+            if shards is None or not version.sharded:
+                items.extend(self._query_state(state))
+            else:
+                for first, last in _ranges(shards):
+                    items.extend(self._query_state(state, first, last))
+        if not version.sharded:
+            # gatherings saved before they had a shard are not in the shard index, they are all read once to set it
+            self._set_missing_shards(items)
+            if shards is not None:
+                items = [item for item in items if NUMBER.decode(item.get('shard')) in self._shards]
+
+        self.gatherings: dict[str, Gathering] = {gathering.id: gathering for gathering in Gathering.from_dynamodb_items(items)}
+        # gatherings stored in the legacy format (participants by name) are rewritten completely on the first save
+        self._legacy_ids: set[str] = {item['id']['S'] for item in items if 'votes' not in item}
+        # writes collected by save() and not yet handed over to a unit of work
+        self._writes: list[dict] = []
+        # ids of the gatherings written since the version was last increased
+        self._written_ids: set[str] = set()
+
+        # (chat_id, message_id) -> ids of gatherings with that message, more than one id means inconsistent data
+        self._message_index: dict[tuple[str, int], set[str]] = dict()
+        self._message_keys: dict[str, tuple[str, int]] = dict()
+        # upcoming start and end times by gathering id
+        self._deadlines = DeadlineQueue()
+        for gathering in self.gatherings.values():
+            self._index(gathering)
+        self._read_consistently(list(version.changes))
 
         logger.debug(f"Gatherings read: {self.gatherings}")
 
-    def _from_dynamodb_json(self, dynamodb_json_items) -> dict[str, Gathering]:
-        return {v.id: v for v in map(lambda dynamodb_json: Gathering.from_dynamodb_json(Gathering(), dynamodb_json), dynamodb_json_items['Items'])}
+    def _query_state(self, state: int, first_shard: int = None, last_shard: int = None) -> list[dict]:
+        items = []
+        arguments = {
+            'TableName': self._table_name,
+            'IndexName': self._state_index_name,
+            'KeyConditionExpression': '#state = :state',
+            'ExpressionAttributeNames': {'#state': 'state'},
+            'ExpressionAttributeValues': {':state': NUMBER.encode(state)},
+        }
+        if first_shard is not None:
+            arguments['IndexName'] = self._state_shard_index_name
+            arguments['KeyConditionExpression'] += ' AND #shard BETWEEN :first_shard AND :last_shard'
+            arguments['ExpressionAttributeNames']['#shard'] = 'shard'
+            arguments['ExpressionAttributeValues'][':first_shard'] = NUMBER.encode(first_shard)
+            arguments['ExpressionAttributeValues'][':last_shard'] = NUMBER.encode(last_shard)
+        while True:
+            result = self._dynamodb_client.query(**arguments)
+            logger.debug(f"Gatherings read, dynamodb result: {result}")
+
+            items.extend(result['Items'])
+            last_evaluated_key = result.get('LastEvaluatedKey')
+            if last_evaluated_key is None:
+                return items
+            arguments['ExclusiveStartKey'] = last_evaluated_key
+
+    def _set_missing_shards(self, items: list[dict]):
+        """Set the shard of the items without one and mark the gatherings as sharded
+
+        Only the shard is written and only where it is missing, not to overwrite the writes of other invocations.
+        """
+
+        for item in items:
+            if NUMBER.decode(item.get('shard')) is not None:
+                continue
+            shard = shard_of(STRING.decode(item['chat_id']))
+            try:
+                result = self._dynamodb_client.update_item(
+                    TableName=self._table_name,
+                    Key={'id': item['id']},
+                    UpdateExpression='SET #shard = :shard',
+                    ConditionExpression='attribute_exists(#id) AND attribute_not_exists(#shard)',
+                    ExpressionAttributeNames={'#id': 'id', '#shard': 'shard'},
+                    ExpressionAttributeValues={':shard': NUMBER.encode(shard)}
+                )
+                logger.debug(f"Gathering shard set, dynamodb result: {result}")
+            except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+                logger.debug(f"Gathering shard already set: {item['id']}")
+            item['shard'] = NUMBER.encode(shard)
+
+        result = self._dynamodb_client.update_item(
+            TableName=self._version_table_name,
+            Key={'id': STRING.encode(self._version_entry_id)},
+            UpdateExpression='SET #sharded = :true',
+            ExpressionAttributeNames={'#sharded': 'sharded'},
+            ExpressionAttributeValues={':true': BOOL.encode(True)}
+        )
+        logger.debug(f"Gatherings marked as sharded, dynamodb result: {result}")
+
+    def _read_version(self) -> _GatheringsVersion:
+        result = self._dynamodb_client.get_item(
+            TableName=self._version_table_name,
+            Key={'id': STRING.encode(self._version_entry_id)},
+            ConsistentRead=True
+        )
+        logger.debug(f"Gatherings version read, dynamodb result: {result}")
+        return _GatheringsVersion().from_dynamodb_json(result.get('Item') or {})
+
+    def refresh(self) -> bool:
+        """Read the gatherings written by other invocations since the version was read
+
+        :return: whether the gatherings are up to date, False if the changes are no longer known and all of them
+            have to be read again
+        """
+
+        version = self._read_version()
+        if version.value == self.version:
+            return True
+        # no version means that gatherings were never written
+        known = self.version or 0
+        if (version.pruned or 0) > known:
+            return False
+        logger.debug(f"Gatherings changed from version {self.version} to {version.value}")
+        self._read_consistently([id for id, changed in version.changes.items() if changed > known])
+        self.version = version.value
+        return True
+
+    def _read_consistently(self, ids: list[str]):
+        """Replace the gatherings with their stored items, read from the table instead of the index"""
 
-    def get_by_message_id(self, message_id: int) -> Gathering:
-        gatherings = {v for k, v in self.gatherings.items() if v.message_id == message_id}
-        gatherings_len = len(gatherings)
-        if gatherings_len == 0:
+        for i in range(0, len(ids), self._batch_get_max_keys):
+            request_items = {self._table_name: {
+                'Keys': [{'id': STRING.encode(id)} for id in ids[i:i + self._batch_get_max_keys]],
+                'ConsistentRead': True
+            }}
+            items = []
+            while request_items:
+                result = self._dynamodb_client.batch_get_item(RequestItems=request_items)
+                logger.debug(f"Gatherings read again, dynamodb result: {result}")
+                items.extend(result['Responses'].get(self._table_name, []))
+                request_items = result.get('UnprocessedKeys')
+
+            for item in items:
+                gathering = Gathering().from_dynamodb_json(item)
+                shard = gathering.shard if gathering.shard is not None else shard_of(gathering.chat_id)
+                if self._shards is not None and shard not in self._shards:
+                    continue
+                if 'votes' not in item:
+                    self._legacy_ids.add(gathering.id)
+                else:
+                    self._legacy_ids.discard(gathering.id)
+                self._index(gathering)
+                if gathering.state in self._active_states:
+                    self.gatherings[gathering.id] = gathering
+                else:
+                    self.gatherings.pop(gathering.id, None)
+
+    def increase_version(self):
+        """Record the written gatherings for other invocations, to be called after the writes are flushed
+
+        The increase is not conditional, invocations writing gatherings at the same time do not fail each other.
+        """
+
+        ids = sorted(self._written_ids)
+        self._written_ids = set()
+        in_sequence = True
+        for i in range(0, len(ids), self._version_max_ids):
+            version = self._increase_version(ids[i:i + self._version_max_ids])
+            # a larger step means that someone else wrote gatherings in the meantime, they are read on refresh()
+            in_sequence = in_sequence and version.value == (self.version or 0) + 1
+            if in_sequence:
+                self.version = version.value
+            self._prune(version)
+
+    def _increase_version(self, ids: list[str]) -> _GatheringsVersion:
+        # every operand is evaluated before the update, so each id gets the increased version
+        increased = 'if_not_exists(#value, :zero) + :one'
+        names = {'#value': 'value', '#changes': 'changes'}
+        names.update({f'#id{i}': id for i, id in enumerate(ids)})
+        arguments = {
+            'TableName': self._version_table_name,
+            'Key': {'id': STRING.encode(self._version_entry_id)},
+            'UpdateExpression': 'SET ' + ', '.join([f'#value = {increased}'] + [f'#changes.#id{i} = {increased}' for i in range(len(ids))]),
+            # the map has to exist for its entries to be set
+            'ConditionExpression': 'attribute_exists(#changes)',
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': {':zero': NUMBER.encode(0), ':one': NUMBER.encode(1)},
+            'ReturnValues': 'ALL_NEW'
+        }
+        try:
+            result = self._dynamodb_client.update_item(**arguments)
+        except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+            result = self._dynamodb_client.update_item(
+                TableName=self._version_table_name,
+                Key=arguments['Key'],
+                UpdateExpression='SET #changes = if_not_exists(#changes, :empty)',
+                ExpressionAttributeNames={'#changes': 'changes'},
+                ExpressionAttributeValues={':empty': {'M': {}}}
+            )
+            logger.debug(f"Gatherings changes created, dynamodb result: {result}")
+            result = self._dynamodb_client.update_item(**arguments)
+        logger.debug(f"Gatherings version increased, dynamodb result: {result}")
+        return _GatheringsVersion().from_dynamodb_json(result['Attributes'])
+
+    def _prune(self, version: _GatheringsVersion):
+        """Drop the changes of old versions, unless they were written again in the meantime"""
+
+        old = [(id, changed) for id, changed in version.changes.items() if changed <= version.value - self._versions_kept]
+        old = old[:self._version_max_ids]
+        if len(old) == 0:
+            return
+        pruned = max(changed for _, changed in old)
+        names = {'#changes': 'changes', '#pruned': 'pruned'}
+        names.update({f'#id{i}': id for i, (id, _) in enumerate(old)})
+        values = {':pruned': NUMBER.encode(pruned)}
+        values.update({f':v{i}': NUMBER.encode(changed) for i, (_, changed) in enumerate(old)})
+        try:
+            result = self._dynamodb_client.update_item(
+                TableName=self._version_table_name,
+                Key={'id': STRING.encode(self._version_entry_id)},
+                UpdateExpression='SET #pruned = :pruned REMOVE ' + ', '.join(f'#changes.#id{i}' for i in range(len(old))),
+                ConditionExpression=' AND '.join(['(attribute_not_exists(#pruned) OR #pruned <= :pruned)'] +
+                                                 [f'#changes.#id{i} = :v{i}' for i in range(len(old))]),
+                ExpressionAttributeNames=names,
+                ExpressionAttributeValues=values
+            )
+            logger.debug(f"Gatherings changes pruned, dynamodb result: {result}")
+        except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+            logger.debug("Gatherings changes written in the meantime, pruned on the next write")
+
+    def get_by_message_id(self, chat_id: str, message_id: int) -> Gathering:
+        ids = self._message_index.get((chat_id, message_id))
+        ids_len = len(ids) if ids is not None else 0
+        if ids_len == 0:
             return None
-        elif gatherings_len == 1:
-            return gatherings.pop()
+        elif ids_len == 1:
+            return self.gatherings[next(iter(ids))]
         else:
-            raise AwsException(f"Non-unique gatherings by message_id {message_id} found: {gatherings_len} entries")
+            raise AwsException(f"Non-unique gatherings by message_id {message_id} found: {ids_len} entries")
+
+    def pop_due(self, now: int) -> list[Gathering]:
+        """Get the gatherings to start or to end by now, they are scheduled again when saved"""
+
+        return [self.gatherings[id] for id in self._deadlines.pop_due(now) if id in self.gatherings]
+
+    def next_deadline(self) -> int | None:
+        return self._deadlines.next_deadline()
+
+    def _index(self, gathering: Gathering):
+        self._deadlines.schedule(gathering.id, self._deadline(gathering))
+
+        key = (gathering.chat_id, gathering.message_id) \
+            if gathering.message_id is not None and gathering.state != STATE_STOPPED \
+            else None
+        key_old = self._message_keys.get(gathering.id)
+        if key == key_old:
+            return
+
+        if key_old is not None:
+            ids = self._message_index[key_old]
+            ids.discard(gathering.id)
+            if len(ids) == 0:
+                del self._message_index[key_old]
+            del self._message_keys[gathering.id]
+
+        if key is not None:
+            self._message_index.setdefault(key, set()).add(gathering.id)
+            self._message_keys[gathering.id] = key
+
+    def _deadline(self, gathering: Gathering) -> int | None:
+        if gathering.state == STATE_SCHEDULED:
+            return gathering.start
+        elif gathering.state == STATE_STARTED:
+            return gathering.end
+        else:
+            return None
 
     def get_all(self):
         return self.gatherings
 
     def save(self, gathering: Gathering):
-        original = self._gatherings_original.get(gathering.id)
-        if original is None or not self._is_equal(gathering, original):
+        """Collect the changes of the gathering, they are written by write_to()"""
+
+        if gathering.shard is None:
+            gathering.shard = shard_of(gathering.chat_id)
+        if gathering.id not in self.gatherings or gathering.id in self._legacy_ids:
             json = gathering.to_dynamodb_json()
-            result = self._dynamodb_client.put_item(TableName=self._table_name, Item=json)
-            logger.debug(f"Gathering saved, dynamodb result: {result}")
+            self._writes.append({'Put': {'TableName': self._table_name, 'Item': json}})
             logger.debug(f"Gathering saved: {json}")
-        self._gatherings_original[gathering.id] = gathering
-
-    def _is_equal(self, first: Gathering, second: Gathering) -> bool:
-        return (first.chat_id == second.chat_id) \
-            and (first.message_id == second.message_id) \
-            and (first.state == second.state) \
-            and (first.start == second.start) \
-            and (first.end == second.end) \
-            and (first.max_count == second.max_count) \
-            and (first.participants_yes == second.participants_yes) \
-            and (first.participants_maybe == second.participants_maybe) \
-            and (first.participants_no == second.participants_no) \
-            and (first.message_text == second.message_text) \
-            and (first.message_what == second.message_what) \
-            and (first.message_where == second.message_where) \
-            and (first.message_when == second.message_when)
+            self._legacy_ids.discard(gathering.id)
+            self._written_ids.add(gathering.id)
+        elif gathering.is_changed():
+            arguments = gathering.to_dynamodb_update().to_arguments()
+            self._writes.append({'Update': {
+                'TableName': self._table_name,
+                'Key': {'id': STRING.encode(gathering.id)},
+                **arguments
+            }})
+            self._written_ids.add(gathering.id)
+            logger.debug(f"Gathering updated: {arguments}")
+        gathering.reset_changes()
+
+        self._index(gathering)
+        if gathering.state == STATE_STOPPED:
+            self.gatherings.pop(gathering.id, None)
+        else:
+            self.gatherings[gathering.id] = gathering
+
+    def write_to(self, unit_of_work: UnitOfWork) -> bool:
+        """Hand the collected writes over to the unit of work
+
+        :return: whether there was anything to write
+        """
+
+        writes = self._writes
+        self._writes = []
+        for write in writes:
+            unit_of_work.add(write)
+        return len(writes) != 0
+
+
+def _ranges(shards: list[int]) -> list[tuple[int, int]]:
+    """:return: the shards as (first, last) runs of consecutive shards"""
+
+    ranges = []
+    for shard in sorted(shards):
+        if len(ranges) != 0 and ranges[-1][1] == shard - 1:
+            ranges[-1] = (ranges[-1][0], shard)
+        else:
+            ranges.append((shard, shard))
+    return ranges
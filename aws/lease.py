@@ -0,0 +1,244 @@
+import time
+import uuid
+
+import logger
+from .aws_exception import AwsException
+from .dynamodb_document import _Codec, _DynamodbDocument, NUMBER, STRING, map_of
+
+
+class Lease:
+    """An exclusive, expiring claim on a named resource, kept in DynamoDB with conditional writes
+
+    The table has 'id' (S) as the partition key, 'expires' (N, unix time in seconds) can be set as its TTL attribute
+    to have abandoned items removed. A lease is taken over when it expires, so the holder has to renew it
+    by calling heartbeat() well before that.
+
+    :parameter lease_id: the name of the resource
+    :parameter duration: seconds the lease is held for after it is acquired or renewed
+    :parameter owner: the holder id, unique for every process by default
+    """
+
+    _table_name = 'team_gather_bot.leases'
+
+    def __init__(self, dynamodb_client, lease_id: str, duration: int = 60, owner: str = None):
+        self._dynamodb_client = dynamodb_client
+        self.lease_id = lease_id
+        self.duration = duration
+        self.owner = owner if owner is not None else uuid.uuid4().hex
+        # until when the lease is held as far as this process knows, 0 when it is not
+        self._expires = 0
+
+    def acquire(self) -> bool:
+        """Take the lease if it is free, expired or already held by this owner
+
+        :return: whether the lease is held
+        :raise AwsException: if the lease could not be read or written
+        """
+
+        now = int(time.time())
+        expires = now + self.duration
+        try:
+            result = self._dynamodb_client.put_item(
+                TableName=self._table_name,
+                Item={'id': STRING.encode(self.lease_id), 'owner': STRING.encode(self.owner), 'expires': NUMBER.encode(expires)},
+                ConditionExpression='attribute_not_exists(#id) OR #expires <= :now OR #owner = :owner',
+                ExpressionAttributeNames={'#id': 'id', '#expires': 'expires', '#owner': 'owner'},
+                ExpressionAttributeValues={':now': NUMBER.encode(now), ':owner': STRING.encode(self.owner)}
+            )
+            logger.debug(f"Lease {self.lease_id} acquired, dynamodb result: {result}")
+        except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+            logger.debug(f"Lease {self.lease_id} is held by another owner")
+            self._expires = 0
+            return False
+        except self._dynamodb_client.exceptions.ClientError as e:
+            raise AwsException(f"Failed to acquire lease {self.lease_id}: {e}")
+        self._expires = expires
+        return True
+
+    def heartbeat(self) -> bool:
+        """Renew the lease once half of its duration is over
+
+        :return: whether the lease is still held, it is lost if it expired and was taken over by another owner
+        :raise AwsException: if the lease could not be written
+        """
+
+        if self._expires - time.time() > self.duration / 2:
+            return True
+        now = int(time.time())
+        expires = now + self.duration
+        try:
+            result = self._dynamodb_client.update_item(
+                TableName=self._table_name,
+                Key={'id': STRING.encode(self.lease_id)},
+                UpdateExpression='SET #expires = :expires',
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#expires': 'expires', '#owner': 'owner'},
+                ExpressionAttributeValues={':expires': NUMBER.encode(expires), ':owner': STRING.encode(self.owner)}
+            )
+            logger.debug(f"Lease {self.lease_id} renewed, dynamodb result: {result}")
+        except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+            logger.warn(f"Lease {self.lease_id} lost")
+            self._expires = 0
+            return False
+        except self._dynamodb_client.exceptions.ClientError as e:
+            raise AwsException(f"Failed to renew lease {self.lease_id}: {e}")
+        self._expires = expires
+        return True
+
+    def release(self):
+        """Give the lease up, so that another owner can acquire it without waiting for it to expire
+
+        :raise AwsException: if the lease could not be written
+        """
+
+        if self._expires == 0:
+            return
+        self._expires = 0
+        try:
+            result = self._dynamodb_client.delete_item(
+                TableName=self._table_name,
+                Key={'id': STRING.encode(self.lease_id)},
+                ConditionExpression='#owner = :owner',
+                ExpressionAttributeNames={'#owner': 'owner'},
+                ExpressionAttributeValues={':owner': STRING.encode(self.owner)}
+            )
+            logger.debug(f"Lease {self.lease_id} released, dynamodb result: {result}")
+        except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+            logger.debug(f"Lease {self.lease_id} was already taken over")
+        except self._dynamodb_client.exceptions.ClientError as e:
+            raise AwsException(f"Failed to release lease {self.lease_id}: {e}")
+
+
+class _ShardLeaseState(_DynamodbDocument):
+    """Workers and shard leases of a ShardLeases item, shards are keyed by their number as a string"""
+
+    __slots__ = ('version', 'workers', 'shard_owners', 'shard_expires', 'shard_processed')
+    _codec = _Codec([
+        ('version', 'version', NUMBER),
+        # owner -> until when the worker is counted as alive
+        ('workers', 'workers', map_of(NUMBER)),
+        ('shard_owners', 'shard_owners', map_of(STRING)),
+        ('shard_expires', 'shard_expires', map_of(NUMBER)),
+        # when the shards were last released
+        ('shard_processed', 'shard_processed', map_of(NUMBER)),
+    ])
+
+
+class ShardLeases:
+    """Splits shards among the workers that are alive, a shard is only processed by the holder of its lease
+
+    The workers and the shard leases are kept in a single item, read and written as a whole with a version condition.
+    Every worker renews its entry as a heartbeat when it acquires its shards. The live workers are ordered by owner:
+    worker i of n is assigned the i-th of n ranges of consecutive shards. Shards are only leased while they are
+    processed, so a worker that is gone holds nothing after its last invocation ends. The range of a worker that is gone
+    but not expired yet is taken by the others with acquire(others=True), which takes any shard that is neither held
+    nor processed in the last few seconds.
+
+    :parameter name: the id of the item in the lease table
+    :parameter shard_count: the number of shards
+    :parameter duration: seconds a worker is counted as alive after acquiring, longer than the time between two invocations
+    """
+
+    # shards processed this recently are skipped, the gatherings index may not show the writes of the previous holder yet
+    _processed_recently = 10
+
+    def __init__(self, dynamodb_client, name: str, shard_count: int, duration: int = 120, owner: str = None,
+                 max_attempts: int = 5):
+        self._dynamodb_client = dynamodb_client
+        self._name = name
+        self._shard_count = shard_count
+        self._duration = duration
+        self.owner = owner if owner is not None else uuid.uuid4().hex
+        self._max_attempts = max_attempts
+
+    def acquire(self, until: float, others: bool = False) -> list[int]:
+        """Take the leases of the free shards assigned to this worker, or of the free ones assigned to the others
+
+        :parameter until: unix time when the leases expire, when the processing ends at the latest
+        :parameter others: whether to take the shards of the other workers instead
+        :return: the shards taken, to be given back with release()
+        :raise AwsException: if the leases could not be read or written
+        """
+
+        def take(state: _ShardLeaseState, now: int) -> list[int] | None:
+            workers = {owner: expires for owner, expires in state.workers.items() if expires > now}
+            workers[self.owner] = now + self._duration
+            state.workers = workers
+            owners = sorted(workers)
+            i = owners.index(self.owner)
+            assigned = range(i * self._shard_count // len(owners), (i + 1) * self._shard_count // len(owners))
+
+            shards = [shard for shard in range(self._shard_count)
+                      if (shard in assigned) != others and self._is_free(state, str(shard), now)]
+            if others and len(shards) == 0:
+                # the heartbeat was written when the assigned shards were taken
+                return None
+            for shard in shards:
+                state.shard_owners[str(shard)] = self.owner
+                state.shard_expires[str(shard)] = int(until)
+            logger.debug(f"Shards assigned: {assigned.start}-{assigned.stop - 1} of {len(owners)} workers, "
+                         f"taken{' of the others' if others else ''}: {shards}")
+            return shards
+
+        shards = self._update(take)
+        return shards if shards is not None else []
+
+    def release(self, shards: list[int]):
+        """Give the leases back after the shards are processed
+
+        :raise AwsException: if the leases could not be read or written
+        """
+
+        def give_back(state: _ShardLeaseState, now: int) -> list[int]:
+            released = [shard for shard in shards if state.shard_owners.get(str(shard)) == self.owner]
+            for shard in released:
+                del state.shard_owners[str(shard)]
+                del state.shard_expires[str(shard)]
+                state.shard_processed[str(shard)] = now
+            return released
+
+        if len(shards) != 0:
+            self._update(give_back)
+
+    def _is_free(self, state: _ShardLeaseState, shard: str, now: int) -> bool:
+        return (shard not in state.shard_owners or state.shard_expires.get(shard, 0) <= now) \
+            and state.shard_processed.get(shard, 0) <= now - self._processed_recently
+
+    def _update(self, change):
+        """Read the item, change it and write it back unless someone else wrote it in the meantime, then retry
+
+        :parameter change: function of the state and the current time, returns the result or None if nothing changed
+        """
+
+        key = {'id': STRING.encode(self._name)}
+        for attempt in range(self._max_attempts):
+            try:
+                result = self._dynamodb_client.get_item(TableName=Lease._table_name, Key=key, ConsistentRead=True)
+                logger.debug(f"Shard leases read, dynamodb result: {result}")
+                state = _ShardLeaseState()
+                state.from_dynamodb_json(result.get('Item') or {})
+
+                now = int(time.time())
+                changed = change(state, now)
+                if changed is None:
+                    return None
+
+                version = state.version
+                state.version = (version or 0) + 1
+                item = state.to_dynamodb_json()
+                item['id'] = key['id']
+                put = {'TableName': Lease._table_name, 'Item': item}
+                if version is None:
+                    put['ConditionExpression'] = 'attribute_not_exists(id)'
+                else:
+                    put['ConditionExpression'] = '#version = :version'
+                    put['ExpressionAttributeNames'] = {'#version': 'version'}
+                    put['ExpressionAttributeValues'] = {':version': NUMBER.encode(version)}
+                result = self._dynamodb_client.put_item(**put)
+                logger.debug(f"Shard leases written, dynamodb result: {result}")
+                return changed
+            except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+                logger.debug(f"Shard leases written by another worker, retrying (attempt {attempt + 1})")
+            except self._dynamodb_client.exceptions.ClientError as e:
+                raise AwsException(f"Failed to write shard leases {self._name}: {e}")
+        raise AwsException(f"Shard leases {self._name} not written after {self._max_attempts} attempts")
@@ -1,55 +1,136 @@
 import logger
 from .aws_exception import AwsException
-from .dynamodb_document import _DynamodbDocument
+from .dynamodb_document import _Codec, _DynamodbDocument, STRING, NUMBER
+from .unit_of_work import UnitOfWork
 
 
 class Settings(_DynamodbDocument):
+    """Global settings and bot state, the timezone and the locale are defaults for chats without their own settings"""
+
     _table_name = 'team_gather_bot.settings'
+    _entry_id = '1'
+    _codec = _Codec([
+        ('timezone', 'timezone', STRING),
+        ('locale', 'locale', STRING),
+        ('last_update_id', 'last_update_id', NUMBER),
+        ('last_update_time', 'last_update_time', NUMBER),
+        # ids are allocated by GatheringIdAllocator, the last id allocated before is where it starts
+        ('last_gathering_id', 'last_gathering_id', STRING),
+        ('version', 'version', NUMBER),
+    ])
 
     def __init__(self, dynamodb_client):
         self._dynamodb_client = dynamodb_client
 
-        result = self._dynamodb_client.scan(TableName=self._table_name)
+        result = self._dynamodb_client.get_item(
+            TableName=self._table_name,
+            Key={'id': STRING.encode(self._entry_id)},
+            ConsistentRead=True
+        )
         logger.debug(f"Settings read, dynamodb result: {result}")
 
-        items = result['Items']
-        items_len = len(items)
-        if items_len == 0:
-            self._entry_id = '1'
+        item = result.get('Item')
+        migrated = False
+        if item is None:
+            item = self._read_item_with_other_id()
+            migrated = item is not None
+        if item is None:
             self.timezone = 'Europe/Berlin'
             self.locale = 'en'
             self.last_update_id = -1
             self.last_update_time = 0
             self.last_gathering_id = '0'
-        elif items_len == 1:
-            item = items[0]
-            self._entry_id = self._from_dynamodb_json(item['id'])
-            self.timezone = self._from_dynamodb_json(item['timezone'])
-            self.locale = self._from_dynamodb_json(item['locale'])
-            self.last_update_id = self._from_dynamodb_json(item['last_update_id'])
-            self.last_update_time = self._from_dynamodb_json(item['last_update_time'])
-            self.last_gathering_id = self._from_dynamodb_json(item['last_gathering_id'])
+            self.version = None
         else:
-            raise AwsException("Non-unique settings entry: found {} entries".format(items_len))
+            self.from_dynamodb_json(item)
+            if migrated:
+                # saved under the fixed id on the next pass, the stored item is new there
+                self.version = None
+            elif self.version is None:
+                self.version = 0
+        self._saved = self._values() if not migrated else None
 
         logger.debug(f"Settings read: {self}")
 
-    def next_gathering_id(self) -> str:
-        self.last_gathering_id = str(int(self.last_gathering_id) + 1)
-        return self.last_gathering_id
-
-    def save(self):
-        item = {
-            'id': self._to_dynamodb_json(self._entry_id),
-            'timezone': self._to_dynamodb_json(self.timezone),
-            'locale': self._to_dynamodb_json(self.locale),
-            'last_update_id': self._to_dynamodb_json(self.last_update_id),
-            'last_update_time': self._to_dynamodb_json(self.last_update_time),
-            'last_gathering_id': self._to_dynamodb_json(self.last_gathering_id),
+    def _read_item_with_other_id(self) -> dict | None:
+        """Settings used to be stored under any id and found with a scan, such an item is taken over once
+
+        Other items of the table (e.g. the gathering id counter) have no 'last_update_id'.
+        """
+
+        items = []
+        arguments = {
+            'TableName': self._table_name,
+            'FilterExpression': 'attribute_exists(#last_update_id)',
+            'ExpressionAttributeNames': {'#last_update_id': 'last_update_id'},
+            'ConsistentRead': True,
         }
-        result = self._dynamodb_client.put_item(TableName=self._table_name, Item=item, ReturnValues='ALL_OLD')
-        logger.debug(f"Settings saved, dynamodb result: {result}")
-        logger.debug(f"Settings saved: {self}")
+        while True:
+            result = self._dynamodb_client.scan(**arguments)
+            logger.debug(f"Settings scanned, dynamodb result: {result}")
+
+            items.extend(result['Items'])
+            last_evaluated_key = result.get('LastEvaluatedKey')
+            if last_evaluated_key is None:
+                break
+            arguments['ExclusiveStartKey'] = last_evaluated_key
+
+        if len(items) == 0:
+            return None
+        if len(items) > 1:
+            raise AwsException("Non-unique settings entry: found {} entries".format(len(items)))
+        logger.info(f"Settings found under id {STRING.decode(items[0]['id'])}, they are saved under id {self._entry_id}")
+        return items[0]
+
+    def read_version(self) -> int | None:
+        """Read only the version of the stored settings, it changes on every save
+
+        :return: the stored version, None if there are no stored settings yet
+        """
+
+        result = self._dynamodb_client.get_item(
+            TableName=self._table_name,
+            Key={'id': STRING.encode(self._entry_id)},
+            ProjectionExpression='#version',
+            ExpressionAttributeNames={'#version': 'version'},
+            ConsistentRead=True
+        )
+        item = result.get('Item')
+        if item is None:
+            return None
+        return NUMBER.decode(item.get('version')) or 0
+
+    def is_changed(self) -> bool:
+        return self._values() != self._saved
+
+    def write_to(self, unit_of_work: UnitOfWork):
+        """Add the settings write to the unit of work, the version is increased once it is written
+
+        The write is conditional, the unit of work fails if the settings were saved by someone else since they were read.
+        """
+
+        version = (self.version or 0) + 1
+        item = self.to_dynamodb_json()
+        item['id'] = STRING.encode(self._entry_id)
+        item['version'] = NUMBER.encode(version)
+        put = {'TableName': self._table_name, 'Item': item}
+        if self.version is None:
+            put['ConditionExpression'] = 'attribute_not_exists(id)'
+        else:
+            put['ConditionExpression'] = 'attribute_not_exists(#version) OR #version = :version'
+            put['ExpressionAttributeNames'] = {'#version': 'version'}
+            put['ExpressionAttributeValues'] = {':version': NUMBER.encode(self.version)}
+        values = self._values()
+
+        def on_written():
+            self.version = version
+            self._saved = values
+            logger.debug(f"Settings saved: {self}")
+
+        unit_of_work.add({'Put': put}, on_written)
+
+    def _values(self) -> tuple:
+        return self.timezone, self.locale, self.last_update_id, self.last_update_time, self.last_gathering_id
 
     def __repr__(self) -> str:
         return str(self.__dict__)
@@ -0,0 +1,103 @@
+import time
+
+import logger
+from .aws_exception import AwsException
+
+
+class UnitOfWork:
+    """Collects DynamoDB writes of a handler pass and flushes them in as few calls as possible
+
+    Writes are given in the TransactWriteItems format: {'Put': {...}} or {'Update': {...}}.
+    Unconditional puts are written with BatchWriteItem, all the other writes with TransactWriteItems
+    in the order they were added, so that the last added write (the settings with the update offset)
+    is committed together with or after everything else.
+    """
+
+    _batch_write_max_items = 25
+    _transact_write_max_items = 100
+    _retryable_cancellation_reasons = {'TransactionConflict', 'ThrottlingError', 'ProvisionedThroughputExceeded'}
+
+    def __init__(self, dynamodb_client, max_attempts: int = 5, backoff: float = 0.05):
+        self._dynamodb_client = dynamodb_client
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._puts: list[dict] = []
+        self._transact_items: list[dict] = []
+        self._callbacks = []
+
+    def add(self, write: dict, on_written=None):
+        put = write.get('Put')
+        if put is not None and 'ConditionExpression' not in put:
+            self._puts.append(put)
+        else:
+            self._transact_items.append(write)
+        if on_written is not None:
+            self._callbacks.append(on_written)
+
+    def flush(self):
+        """Write everything collected so far
+
+        :raise AwsException: if a condition failed or retries were exhausted
+        """
+
+        for i in range(0, len(self._puts), self._batch_write_max_items):
+            self._batch_write(self._puts[i:i + self._batch_write_max_items])
+        for i in range(0, len(self._transact_items), self._transact_write_max_items):
+            self._transact_write(self._transact_items[i:i + self._transact_write_max_items])
+
+        callbacks = self._callbacks
+        self._puts = []
+        self._transact_items = []
+        self._callbacks = []
+        for callback in callbacks:
+            callback()
+
+    def _batch_write(self, puts: list[dict]):
+        request_items = dict()
+        for put in puts:
+            request_items.setdefault(put['TableName'], []).append({'PutRequest': {'Item': put['Item']}})
+
+        for attempt in range(self._max_attempts):
+            if attempt > 0:
+                self._sleep(attempt)
+            result = self._dynamodb_client.batch_write_item(RequestItems=request_items)
+            logger.debug(f"Batch written, dynamodb result: {result}")
+            request_items = result.get('UnprocessedItems')
+            if not request_items:
+                return
+        raise AwsException(f"Batch write not completed after {self._max_attempts} attempts: {request_items}")
+
+    def _transact_write(self, items: list[dict]):
+        for attempt in range(self._max_attempts):
+            if attempt > 0:
+                self._sleep(attempt)
+            try:
+                if len(items) == 1:
+                    # a single write does not need a transaction, which costs twice as many write units
+                    self._write_single(items[0])
+                else:
+                    result = self._dynamodb_client.transact_write_items(TransactItems=items)
+                    logger.debug(f"Transaction written, dynamodb result: {result}")
+                return
+            except self._dynamodb_client.exceptions.ConditionalCheckFailedException:
+                raise AwsException(f"Write condition failed: {items[0]}")
+            except self._dynamodb_client.exceptions.TransactionCanceledException as e:
+                reasons = {reason.get('Code') for reason in e.response.get('CancellationReasons', [])} - {'None'}
+                if 'ConditionalCheckFailed' in reasons or not reasons <= self._retryable_cancellation_reasons:
+                    raise AwsException(f"Transaction cancelled: {reasons}")
+                logger.warn(f"Transaction cancelled, retrying: {reasons}")
+            except (self._dynamodb_client.exceptions.ProvisionedThroughputExceededException,
+                    self._dynamodb_client.exceptions.TransactionConflictException) as e:
+                logger.warn(f"Write failed, retrying: {e}")
+        raise AwsException(f"Transaction not completed after {self._max_attempts} attempts")
+
+    def _write_single(self, item: dict):
+        put = item.get('Put')
+        if put is not None:
+            result = self._dynamodb_client.put_item(**put)
+        else:
+            result = self._dynamodb_client.update_item(**item['Update'])
+        logger.debug(f"Item written, dynamodb result: {result}")
+
+    def _sleep(self, attempt: int):
+        time.sleep(self._backoff * 2 ** (attempt - 1))
@@ -0,0 +1,78 @@
+import datetime
+
+import logger
+from .aws_exception import AwsException
+
+
+class WakeUpScheduler:
+    """Asks for the polling handler to be invoked at a given time
+
+    This implementation only logs the requested time, it stands in when the handler
+    is run locally or is invoked by a fixed schedule only.
+    """
+
+    def __init__(self):
+        self._scheduled: int | None = None
+
+    def schedule(self, timestamp: int):
+        """Request an invocation at the timestamp, repeated requests for the same time are skipped
+
+        :parameter timestamp: unix time in seconds
+        """
+
+        if timestamp == self._scheduled:
+            return
+        self._schedule(timestamp)
+        self._scheduled = timestamp
+
+    def _schedule(self, timestamp: int):
+        logger.info(f"Wake up requested at {timestamp}")
+
+
+class EventBridgeWakeUpScheduler(WakeUpScheduler):
+    """Keeps a one-time EventBridge Scheduler schedule pointing at the next wake up time
+
+    The schedule is created on the first request and updated afterwards.
+    It is kept after it fires (ActionAfterCompletion NONE), so that the name can be reused.
+
+    :parameter scheduler_client: boto3 'scheduler' client
+    :parameter name: the schedule name
+    :parameter target_arn: ARN of the polling handler Lambda function
+    :parameter role_arn: ARN of the role the scheduler assumes to invoke the target
+    :parameter group_name: the schedule group
+    """
+
+    def __init__(self, scheduler_client, name: str, target_arn: str, role_arn: str, group_name: str = 'default'):
+        super().__init__()
+        self._scheduler_client = scheduler_client
+        self._name = name
+        self._target_arn = target_arn
+        self._role_arn = role_arn
+        self._group_name = group_name
+        self._exists: bool | None = None
+
+    def _schedule(self, timestamp: int):
+        at = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+        arguments = {
+            'Name': self._name,
+            'GroupName': self._group_name,
+            'ScheduleExpression': f'at({at})',
+            'ScheduleExpressionTimezone': 'UTC',
+            'FlexibleTimeWindow': {'Mode': 'OFF'},
+            'Target': {'Arn': self._target_arn, 'RoleArn': self._role_arn},
+            'ActionAfterCompletion': 'NONE',
+        }
+        try:
+            if self._exists is not False:
+                try:
+                    self._scheduler_client.update_schedule(**arguments)
+                    self._exists = True
+                    logger.debug(f"Wake up schedule updated: {at}")
+                    return
+                except self._scheduler_client.exceptions.ResourceNotFoundException:
+                    self._exists = False
+            self._scheduler_client.create_schedule(**arguments)
+            self._exists = True
+            logger.debug(f"Wake up schedule created: {at}")
+        except self._scheduler_client.exceptions.ClientError as e:
+            raise AwsException(f"Failed to schedule a wake up at {at}: {e}")
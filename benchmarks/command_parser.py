@@ -0,0 +1,195 @@
+"""Differential check and micro-benchmark of the command parser against the previous character state machine
+
+Run from the repository root: python -m benchmarks.command_parser [random input count]
+"""
+
+import random
+import sys
+import timeit
+
+from service.command_parser import Command, parse
+from service.parse_exception import ParseException
+
+# the previous parser, kept here for comparison only
+
+_STATE_ACTION = 0
+_STATE_EXPECT_WHITESPACE = 1
+_STATE_WHITESPACE = 2
+_STATE_KEY = 3
+_STATE_EXPECT_VALUE = 4
+_STATE_VALUE = 5
+_STATE_QUOTED_VALUE = 6
+_STATE_ESCAPE = 7
+
+_state_name = {
+    _STATE_ACTION: 'ACTION',
+    _STATE_EXPECT_WHITESPACE: 'EXPECT_WHITESPACE',
+    _STATE_WHITESPACE: 'WHITESPACE',
+    _STATE_KEY: 'KEY',
+    _STATE_EXPECT_VALUE: 'EXPECT_VALUE',
+    _STATE_VALUE: 'VALUE',
+    _STATE_QUOTED_VALUE: 'QUOTED_VALUE',
+    _STATE_ESCAPE: 'ESCAPE',
+}
+
+
+def _legacy_parse(command: str, parse_action: bool) -> Command:
+    action = None
+    arguments = {}
+
+    state = _STATE_ACTION if parse_action else _STATE_WHITESPACE
+    key = ''
+    value = ''
+    for c in command:
+        if state == _STATE_ACTION:
+            if _is_valid_unquoted(c):
+                value += c
+            elif c.isspace():
+                action = value
+                value = ''
+                state = _STATE_WHITESPACE
+            else:
+                raise ParseException(command, "command", f"expected alphanumeric, underscore or whitespace in state {_get_state_name(state)}, got '{c}'")
+        elif state == _STATE_WHITESPACE:
+            if _is_valid_unquoted(c):
+                state = _STATE_KEY
+                key += c
+            elif c.isspace():
+                pass
+            else:
+                raise ParseException(command, "command", f"expected alphanumeric, underscore or whitespace in state {_get_state_name(state)}, got '{c}'")
+        elif state == _STATE_EXPECT_WHITESPACE:
+            if c.isspace():
+                state = _STATE_WHITESPACE
+            else:
+                raise ParseException(command, "command", f"expected whitespace in state {_get_state_name(state)}, got '{c}'")
+        elif state == _STATE_KEY:
+            if _is_valid_unquoted(c):
+                key += c
+            elif c == ':':
+                if len(key) == 0:
+                    raise ParseException(command, "command", "expected key name")
+                state = _STATE_EXPECT_VALUE
+            else:
+                raise ParseException(command, "command", f"expected alphanumeric, underscore or colon in state {_get_state_name(state)}, got '{c}'")
+        elif state == _STATE_EXPECT_VALUE:
+            if c == '"':
+                state = _STATE_QUOTED_VALUE
+            elif _is_valid_unquoted(c):
+                value += c
+                state = _STATE_VALUE
+            elif c.isspace():
+                arguments[key] = value
+                key = ''
+                value = ''
+            else:
+                raise ParseException(command, "command", f"expected alphanumeric, underscore, whitespace or quote in state {_get_state_name(state)}, got '{c}'")
+        elif state == _STATE_VALUE:
+            if _is_valid_unquoted(c):
+                value += c
+            elif c.isspace():
+                arguments[key] = value
+                key = ''
+                value = ''
+                state = _STATE_WHITESPACE
+            else:
+                raise ParseException(command, "command", f"expected alphanumeric, underscore or whitespace in state {_get_state_name(state)}, got '{c}'")
+        elif state == _STATE_QUOTED_VALUE:
+            if c == '"':
+                arguments[key] = value
+                key = ''
+                value = ''
+                state = _STATE_EXPECT_WHITESPACE
+            elif c == '\\':
+                state = _STATE_ESCAPE
+            else:
+                value += c
+        elif state == _STATE_ESCAPE:
+            value += c
+            state = _STATE_QUOTED_VALUE
+        else:
+            raise ParseException(command, "command", f"unexpected state {_get_state_name(state)}")
+    if state == _STATE_ACTION:
+        action = value if len(value) > 0 else None
+    elif state == _STATE_WHITESPACE or state == _STATE_EXPECT_WHITESPACE or state == _STATE_VALUE:
+        if len(key) > 0:
+            arguments[key] = value
+    else:
+        raise ParseException(command, "command", f"invalid end state {_get_state_name(state)}")
+
+    return Command(action, arguments)
+
+
+def _is_valid_unquoted(c: str) -> bool:
+    return c.isalnum() or c == '_'
+
+
+def _get_state_name(state: int) -> str:
+    return _state_name.get(state, str(state))
+
+
+_corpus = [
+    '', ' ', 'help', 'help ', ' help', 'help  ', 'help\t\n', 'hel-p', 'schedule what:Football',
+    'schedule what:"Foot ball" where:Park when:"tomorrow 19:00" start:"10:00" end:"23:59" max:10',
+    'schedule what:"with \\"escaped\\" quotes"', 'schedule what:"back\\\\slash"', 'schedule what:"unterminated',
+    'schedule what:"escape at the end\\', 'schedule what:', 'schedule what: ', 'schedule what: Football',
+    'schedule what:  Football', 'schedule what: "Foot ball"', 'schedule what:  "x" y:z', 'schedule what:"x"y:z',
+    'schedule what:"x"  y:z', 'schedule what', 'schedule what ', 'schedule :x', 'schedule what:a-b', 'schedule what:a,b',
+    'schedule what:x:y', 'schedule wh-at:x', 'schedule what:"" where:""', 'schedule   what:x   where:y   ',
+    'schedule what:\u0444\u0443\u0442\u0431\u043e\u043b', 'schedule \u0447\u0442\u043e:\u0444\u0443\u0442\u0431\u043e\u043b',
+    'schedule what:\u00b2\u00bd\u0663', 'schedule what:x\u00a0where:y', 'schedule what:"x"\u2003y:z', 'edit what:x what:y',
+    'schedule what:"multi\nline"', '\u00b2', '_', 'a_b c_d:e_f',
+]
+
+_alphabet = ['a', 'b', 'Z', '0', '_', ':', '"', '\\', ' ', '\t', '\n', '-', '.', '\u00e9', '\u00b2', '\u00a0', '\u2003', '\u0444']
+
+
+def _result(parser, command: str, parse_action: bool):
+    try:
+        result = parser(command, parse_action)
+        return result.action, result.arguments
+    except ParseException as e:
+        return 'error', str(e)
+
+
+def _check(commands: list[str]) -> int:
+    differences = 0
+    for command in commands:
+        for parse_action in (True, False):
+            expected = _result(_legacy_parse, command, parse_action)
+            actual = _result(parse, command, parse_action)
+            if actual != expected:
+                differences += 1
+                print(f'different result for {command!r} (parse_action={parse_action}): {actual!r} instead of {expected!r}')
+    return differences
+
+
+def _measure(name: str, function, number: int):
+    best = min(timeit.repeat(function, number=number, repeat=5)) / number
+    print(f'{name:<40}{best * 1000000:12.1f} us')
+    return best
+
+
+def main(count: int):
+    rng = random.Random(1)
+    commands = _corpus + [''.join(rng.choice(_alphabet) for _ in range(rng.randint(1, 24))) for _ in range(count)]
+    differences = _check(commands)
+    print(f'{len(commands)} inputs compared, {differences} differences')
+
+    description = 'Football in the park. ' * 200
+    escaped = description.replace('.', '\\"')
+    for name, command in [
+        ('short command', 'schedule what:Football where:Park max:10'),
+        (f'{len(description)} chars quoted', f'schedule what:"{description}" where:Park'),
+        (f'{len(escaped)} chars quoted with escapes', f'schedule what:"{escaped}" where:Park'),
+    ]:
+        number = 200 if len(command) > 100 else 20000
+        legacy = _measure(f'{name}, state machine', lambda: _legacy_parse(command, True), number)
+        current = _measure(f'{name}, tokenizer', lambda: parse(command, True), number)
+        print(f'speedup {legacy / current:.1f}x')
+
+    sys.exit(1 if differences != 0 else 0)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
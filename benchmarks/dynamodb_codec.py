@@ -0,0 +1,144 @@
+"""Micro-benchmark of the schema-compiled DynamoDB codec against the previous isinstance-based conversion
+
+Run from the repository root: python -m benchmarks.dynamodb_codec [item count]
+"""
+
+import sys
+import timeit
+
+from aws.gatherings import Gathering, VOTE_YES, VOTE_MAYBE, VOTE_NO, shard_of
+
+
+class _LegacyDocument:
+    """The previous generic conversion, kept here for comparison only"""
+
+    def _to_dynamodb_json(self, value) -> dict:
+        if value is None:
+            return {'NULL': True}
+        elif isinstance(value, bool):
+            return {'BOOL': value}
+        elif isinstance(value, str):
+            return {'S': value}
+        elif isinstance(value, int):
+            return {'N': str(value)}
+        elif isinstance(value, list) or isinstance(value, set):
+            return {'L': list(map(lambda v: self._to_dynamodb_json(v), value))}
+        elif isinstance(value, dict):
+            return {'M': {k: self._to_dynamodb_json(v) for k, v in value.items()}}
+        else:
+            return {'S': str(value)}
+
+    def _from_dynamodb_json(self, dynamodb_json: dict):
+        value = dynamodb_json.get('BOOL')
+        if value is not None:
+            return value
+
+        value = dynamodb_json.get('S')
+        if value is not None:
+            return value
+
+        value = dynamodb_json.get('N')
+        if value is not None:
+            return int(value)
+
+        value = dynamodb_json.get('SS')
+        if value is not None:
+            return set(value)
+
+        value = dynamodb_json.get('L')
+        if value is not None:
+            return map(lambda v: self._from_dynamodb_json(v), value)
+
+        value = dynamodb_json.get('M')
+        if value is not None:
+            return {k: self._from_dynamodb_json(v) for k, v in value.items()}
+
+        return None
+
+
+class _LegacyGathering(_LegacyDocument):
+    def to_dynamodb_json(self, gathering: Gathering) -> dict:
+        return {
+            'id': self._to_dynamodb_json(gathering.id),
+            'chat_id': self._to_dynamodb_json(gathering.chat_id),
+            'shard': self._to_dynamodb_json(gathering.shard),
+            'message_id': self._to_dynamodb_json(gathering.message_id),
+            'state': self._to_dynamodb_json(gathering.state),
+            'start': self._to_dynamodb_json(gathering.start),
+            'end': self._to_dynamodb_json(gathering.end),
+            'max_count': self._to_dynamodb_json(gathering.max_count),
+            'votes': self._to_dynamodb_json(gathering.votes),
+            'names': self._to_dynamodb_json(gathering.names),
+            'message': self._to_dynamodb_json({
+                'text': gathering.message_text,
+                'what': gathering.message_what,
+                'where': gathering.message_where,
+                'when': gathering.message_when,
+                'hash': gathering.message_hash,
+            }),
+        }
+
+    def from_dynamodb_json(self, dynamodb_json: dict) -> Gathering:
+        gathering = Gathering()
+        gathering.id = self._from_dynamodb_json(dynamodb_json['id'])
+        gathering.chat_id = self._from_dynamodb_json(dynamodb_json['chat_id'])
+        gathering.shard = self._from_dynamodb_json(dynamodb_json['shard'])
+        gathering.message_id = self._from_dynamodb_json(dynamodb_json['message_id'])
+        gathering.state = self._from_dynamodb_json(dynamodb_json['state'])
+        gathering.start = self._from_dynamodb_json(dynamodb_json['start'])
+        gathering.end = self._from_dynamodb_json(dynamodb_json['end'])
+        gathering.max_count = self._from_dynamodb_json(dynamodb_json['max_count'])
+        gathering._votes = self._from_dynamodb_json(dynamodb_json['votes'])
+        gathering._names = self._from_dynamodb_json(dynamodb_json['names'])
+        messages = self._from_dynamodb_json(dynamodb_json['message'])
+        gathering.message_text = messages.get('text')
+        gathering.message_what = messages.get('what')
+        gathering.message_where = messages.get('where')
+        gathering.message_when = messages.get('when')
+        gathering.message_hash = messages.get('hash')
+        return gathering
+
+
+def _new_gathering(i: int) -> Gathering:
+    gathering = Gathering()
+    gathering.id = str(i)
+    gathering.chat_id = str(-1000000000 - i % 100)
+    gathering.shard = shard_of(gathering.chat_id)
+    gathering.message_id = 1000 + i
+    gathering.state = 1
+    gathering.start = 1700000000 + i
+    gathering.end = 1700003600 + i
+    gathering.max_count = 10
+    for user_id in range(8):
+        gathering.vote(str(100000 + user_id), f'@user{user_id}', (VOTE_YES, VOTE_MAYBE, VOTE_NO)[user_id % 3])
+    gathering.message_what = 'Football'
+    gathering.message_where = 'Park'
+    gathering.message_hash = '0123456789abcdef0123456789abcdef01234567'
+    return gathering
+
+
+def _measure(name: str, function, repeat: int = 5):
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    print(f'{name:<32}{best * 1000:10.1f} ms')
+    return best
+
+
+def main(count: int):
+    gatherings = [_new_gathering(i) for i in range(count)]
+    legacy = _LegacyGathering()
+    items = [gathering.to_dynamodb_json() for gathering in gatherings]
+    assert items == [legacy.to_dynamodb_json(gathering) for gathering in gatherings]
+    assert [g.to_dynamodb_json() for g in Gathering.from_dynamodb_items(items)] == items
+
+    print(f'{count} items')
+    legacy_decode = _measure('decode, isinstance chain', lambda: [legacy.from_dynamodb_json(item) for item in items])
+    # Gatherings used to decode the query result twice, once more for the original copies
+    _measure('decode twice, isinstance chain', lambda: [legacy.from_dynamodb_json(item) for item in items + items])
+    codec_decode = _measure('decode page, codec', lambda: Gathering.from_dynamodb_items(items))
+    legacy_encode = _measure('encode, isinstance chain', lambda: [legacy.to_dynamodb_json(gathering) for gathering in gatherings])
+    codec_encode = _measure('encode, codec', lambda: [gathering.to_dynamodb_json() for gathering in gatherings])
+    print(f'decode speedup {legacy_decode / codec_decode:.2f}x, encode speedup {legacy_encode / codec_encode:.2f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
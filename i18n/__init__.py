@@ -0,0 +1,79 @@
+import importlib
+import pkgutil
+import string
+
+DEFAULT_LOCALE = 'en'
+
+_conversions = {'r': 'repr', 's': 'str', 'a': 'ascii'}
+
+
+class Template(str):
+    """A message template with format() compiled from the template once
+
+    Fields are given as in str.format: positional, automatically numbered or named, with optional conversion
+    and format spec. Templates with attribute or index access in fields are formatted by str.format.
+    """
+
+    def __init__(self, value: str):
+        super().__init__()
+        self._render = _compile(value)
+
+    def format(self, *args, **kwargs) -> str:
+        return self._render(args, kwargs)
+
+
+def _compile(template: str):
+    parts = []
+    auto_number = 0
+    for literal, field, spec, conversion in string.Formatter().parse(template):
+        if literal:
+            parts.append(repr(literal))
+        if field is None:
+            continue
+        if field == '':
+            field = str(auto_number)
+            auto_number += 1
+        if (not field.isdigit() and not field.isidentifier()) or '{' in spec:
+            return lambda args, kwargs: str.format(template, *args, **kwargs)
+
+        value = f'args[{field}]' if field.isdigit() else f'kwargs[{field!r}]'
+        if conversion is not None:
+            value = f'{_conversions[conversion]}({value})'
+        parts.append(f'format({value}, {spec!r})' if spec else f'format({value})')
+
+    if len(parts) == 0:
+        return lambda args, kwargs: ''
+    return eval(f"lambda args, kwargs: ''.join(({', '.join(parts)},))")
+
+
+class Catalog:
+    """Messages of a locale as Template attributes, missing messages are taken from the default locale"""
+
+    def __init__(self, locale: str, messages: dict[str, str]):
+        self.locale = locale
+        for name, message in messages.items():
+            setattr(self, name, Template(message))
+
+
+def _load_messages(locale: str) -> dict[str, str]:
+    module = importlib.import_module(f'{__name__}.{locale}')
+    return {name: value for name, value in vars(module).items() if name.isupper() and isinstance(value, str)}
+
+
+def _load_catalogs() -> dict[str, Catalog]:
+    default_messages = _load_messages(DEFAULT_LOCALE)
+    catalogs = {}
+    for module in pkgutil.iter_modules(__path__):
+        catalogs[module.name] = Catalog(module.name, {**default_messages, **_load_messages(module.name)})
+    return catalogs
+
+
+# all the locales are loaded once, on the first import
+_catalogs: dict[str, Catalog] = _load_catalogs()
+
+
+def get_catalog(locale: str) -> Catalog:
+    """:return: the catalog of the locale, the default one if there is no such locale"""
+
+    catalog = _catalogs.get(locale)
+    return catalog if catalog is not None else _catalogs[DEFAULT_LOCALE]
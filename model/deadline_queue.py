@@ -0,0 +1,49 @@
+import heapq
+
+
+class DeadlineQueue:
+    """Min-heap of deadlines by key, each key has at most one deadline
+
+    Rescheduled and cancelled deadlines stay in the heap and are skipped when popped.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[int, str]] = []
+        self._deadlines: dict[str, int] = dict()
+
+    def schedule(self, key: str, deadline: int | None):
+        """Set the deadline of the key, None cancels it"""
+
+        if self._deadlines.get(key) == deadline:
+            return
+        if deadline is None:
+            del self._deadlines[key]
+        else:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, key))
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._compact()
+
+    def next_deadline(self) -> int | None:
+        self._skip_stale()
+        return self._heap[0][0] if len(self._heap) != 0 else None
+
+    def pop_due(self, now: int) -> list[str]:
+        """Remove and return the keys with deadlines not later than now, earliest first"""
+
+        keys = []
+        self._skip_stale()
+        while len(self._heap) != 0 and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            del self._deadlines[key]
+            keys.append(key)
+            self._skip_stale()
+        return keys
+
+    def _skip_stale(self):
+        while len(self._heap) != 0 and self._deadlines.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
@@ -0,0 +1,49 @@
+import time
+
+import logger
+from telegram.api.telegram_api import Telegram
+from telegram.api.telegram_exception import TelegramException
+from telegram.model.response.user import User
+
+# Telegram answers with these codes when the bot token is revoked or replaced
+_INVALID_TOKEN_CODES = {401, 404}
+
+
+class BotIdentity:
+    """Bot user obtained once via getMe and cached for the lifetime of the process
+
+    :parameter telegram: Telegram API client
+    :parameter username: bot username override, getMe is never called when set
+    :parameter ttl: time in seconds after which getMe is called again, never expires when not set
+    """
+
+    def __init__(self, telegram: Telegram, username: str = None, ttl: int = None):
+        self._telegram = telegram
+        self._username = username
+        self._ttl = ttl
+        self._me: User | None = None
+        self._expires = None
+        self._prefix = None
+
+    def me(self) -> User:
+        if self._me is None or (self._expires is not None and time.time() >= self._expires):
+            self._me = self._telegram.get_me()
+            self._expires = time.time() + self._ttl if self._ttl is not None else None
+            self._prefix = None
+            logger.debug(f"Bot identity resolved: {self._me}")
+        return self._me
+
+    def command_prefix(self) -> str:
+        if self._username is None:
+            # getMe is called again once the identity expires, which also resets the prefix
+            self.me()
+        if self._prefix is None:
+            username = self._username if self._username is not None else self.me().username
+            self._prefix = '@{} '.format(username)
+        return self._prefix
+
+    def on_error(self, e: TelegramException):
+        if e.code in _INVALID_TOKEN_CODES and self._username is None:
+            logger.warn(f"Bot identity invalidated after Telegram error {e.code}")
+            self._me = None
+            self._prefix = None
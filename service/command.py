@@ -1,4 +1,5 @@
 from aws.gatherings import Gathering
+from telegram.api.async_telegram_api import AsyncTelegram
 from .telegram_command import AbstractTelegramCommand
 
 
@@ -10,18 +11,43 @@ class Command:
     def add_telegram_command(self, command: AbstractTelegramCommand):
         self._telegram_commands.append(command)
 
+    def chat_id(self) -> str | None:
+        if self.gathering is not None:
+            return self.gathering.chat_id
+        return self._telegram_commands[0].chat_id if len(self._telegram_commands) != 0 else None
+
     def execute_telegram_commands(self):
         message_id = None
         for command in self._telegram_commands:
-            if command.type == command.PIN and command.message_id is None:
-                command.message_id = message_id
-
+            if not self._before_execute(command, message_id):
+                continue
             result = command.execute()
+            message_id = self._after_execute(command, result, message_id)
+
+    async def execute_telegram_commands_async(self, telegram: AsyncTelegram):
+        message_id = None
+        for command in self._telegram_commands:
+            if not self._before_execute(command, message_id):
+                continue
+            result = await command.execute_async(telegram)
+            message_id = self._after_execute(command, result, message_id)
+
+    def _before_execute(self, command: AbstractTelegramCommand, message_id: int | None) -> bool:
+        """:return: whether to execute the command, a pin of a message that was not sent is skipped"""
+
+        if command.type == command.PIN and command.message_id is None:
+            command.message_id = message_id
+            return message_id is not None
+        return True
 
-            if command.type == command.SEND:
-                message_id = result.message_id
-                if self.gathering is not None:
-                    self.gathering.message_id = message_id
+    def _after_execute(self, command: AbstractTelegramCommand, result, message_id: int | None) -> int | None:
+        if command.type == command.SEND:
+            # the result is None if the message was not sent, the gathering keeps no message then
+            message_id = result.message_id if result is not None else None
+            if self.gathering is not None and message_id is not None:
+                self.gathering.message_id = message_id
+                self.gathering.message_hash = command.send_message_request.fingerprint()
+        return message_id
 
     def __repr__(self) -> str:
         return f'Command(telegram_commands={self._telegram_commands}, gathering={self.gathering})'
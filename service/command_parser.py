@@ -1,25 +1,12 @@
-from .parse_exception import ParseException
-
+import re
 
-_STATE_ACTION = 0
-_STATE_EXPECT_WHITESPACE = 1
-_STATE_WHITESPACE = 2
-_STATE_KEY = 3
-_STATE_EXPECT_VALUE = 4
-_STATE_VALUE = 5
-_STATE_QUOTED_VALUE = 6
-_STATE_ESCAPE = 7
+from .parse_exception import ParseException
 
-_state_name = {
-    _STATE_ACTION: 'ACTION',
-    _STATE_EXPECT_WHITESPACE: 'EXPECT_WHITESPACE',
-    _STATE_WHITESPACE: 'WHITESPACE',
-    _STATE_KEY: 'KEY',
-    _STATE_EXPECT_VALUE: 'EXPECT_VALUE',
-    _STATE_VALUE: 'VALUE',
-    _STATE_QUOTED_VALUE: 'QUOTED_VALUE',
-    _STATE_ESCAPE: 'ESCAPE',
-}
+# unquoted actions, keys and values: alphanumerics and underscores, the same as str.isalnum() or '_'
+_unquoted = re.compile(r'\w*')
+_whitespace = re.compile(r'\s*')
+# a run of a quoted value up to the closing quote or an escape
+_quoted_run = re.compile(r'[^"\\]*')
 
 
 class Command:
@@ -29,95 +16,101 @@ class Command:
 
 
 def parse(command: str, parse_action: bool) -> Command:
+    """Parse a command: [action] key:value key:"quoted \"value\"" ...
+
+    The input is scanned once, runs of characters are matched by precompiled patterns and sliced out.
+    """
+
+    length = len(command)
     action = None
     arguments = {}
 
-    state = _STATE_ACTION if parse_action else _STATE_WHITESPACE
-    key = ''
-    value = ''
-    for c in command:
-        if state == _STATE_ACTION:
-            if _is_valid_unquoted(c):
-                value += c
-            elif c.isspace():
-                action = value
-                value = ''
-                state = _STATE_WHITESPACE
-            else:
-                raise ParseException(command, "command", f"expected alphanumeric, underscore or whitespace in state {_get_state_name(state)}, got '{c}'")
-        elif state == _STATE_WHITESPACE:
-            if _is_valid_unquoted(c):
-                state = _STATE_KEY
-                key += c
-            elif c.isspace():
-                pass
-            else:
-                raise ParseException(command, "command", f"expected alphanumeric, underscore or whitespace in state {_get_state_name(state)}, got '{c}'")
-        elif state == _STATE_EXPECT_WHITESPACE:
-            if c.isspace():
-                state = _STATE_WHITESPACE
-            else:
-                raise ParseException(command, "command", f"expected whitespace in state {_get_state_name(state)}, got '{c}'")
-        elif state == _STATE_KEY:
-            if _is_valid_unquoted(c):
-                key += c
-            elif c == ':':
-                if len(key) == 0:
-                    raise ParseException(command, "command", "expected key name")
-                state = _STATE_EXPECT_VALUE
-            else:
-                raise ParseException(command, "command", f"expected alphanumeric, underscore or colon in state {_get_state_name(state)}, got '{c}'")
-        elif state == _STATE_EXPECT_VALUE:
-            if c == '"':
-                state = _STATE_QUOTED_VALUE
-            elif _is_valid_unquoted(c):
-                value += c
-                state = _STATE_VALUE
-            elif c.isspace():
-                arguments[key] = value
-                key = ''
-                value = ''
-            else:
-                raise ParseException(command, "command", f"expected alphanumeric, underscore, whitespace or quote in state {_get_state_name(state)}, got '{c}'")
-        elif state == _STATE_VALUE:
-            if _is_valid_unquoted(c):
-                value += c
-            elif c.isspace():
-                arguments[key] = value
-                key = ''
-                value = ''
-                state = _STATE_WHITESPACE
-            else:
-                raise ParseException(command, "command", f"expected alphanumeric, underscore or whitespace in state {_get_state_name(state)}, got '{c}'")
-        elif state == _STATE_QUOTED_VALUE:
-            if c == '"':
-                arguments[key] = value
-                key = ''
-                value = ''
-                state = _STATE_EXPECT_WHITESPACE
-            elif c == '\\':
-                state = _STATE_ESCAPE
-            else:
-                value += c
-        elif state == _STATE_ESCAPE:
-            value += c
-            state = _STATE_QUOTED_VALUE
-        else:
-            raise ParseException(command, "command", f"unexpected state {_get_state_name(state)}")
-    if state == _STATE_ACTION:
-        action = value if len(value) > 0 else None
-    elif state == _STATE_WHITESPACE or state == _STATE_EXPECT_WHITESPACE or state == _STATE_VALUE:
-        if len(key) > 0:
+    i = 0
+    if parse_action:
+        end = _unquoted.match(command, 0).end()
+        if end == length:
+            return Command(command if length > 0 else None, arguments)
+        if not command[end].isspace():
+            raise _unexpected(command, "alphanumeric, underscore or whitespace", 'ACTION', command[end])
+        action = command[:end]
+        i = end + 1
+
+    while True:
+        # between arguments
+        i = _whitespace.match(command, i).end()
+        if i == length:
+            break
+        if not _is_valid_unquoted(command[i]):
+            raise _unexpected(command, "alphanumeric, underscore or whitespace", 'WHITESPACE', command[i])
+
+        end = _unquoted.match(command, i).end()
+        key = command[i:end]
+        if end == length:
+            raise _invalid_end(command, 'KEY')
+        if command[end] != ':':
+            raise _unexpected(command, "alphanumeric, underscore or colon", 'KEY', command[end])
+        i = end + 1
+
+        # whitespace after the colon stores an empty value, a value that follows it has an empty key
+        while i < length and command[i].isspace():
+            arguments[key] = ''
+            key = ''
+            i += 1
+        if i == length:
+            raise _invalid_end(command, 'EXPECT_VALUE')
+
+        c = command[i]
+        if c == '"':
+            value, i = _parse_quoted(command, i + 1)
+            arguments[key] = value
+            if i == length:
+                break
+            if not command[i].isspace():
+                raise _unexpected(command, "whitespace", 'EXPECT_WHITESPACE', command[i])
+            i += 1
+        elif _is_valid_unquoted(c):
+            end = _unquoted.match(command, i).end()
+            value = command[i:end]
+            if end == length:
+                if len(key) > 0:
+                    arguments[key] = value
+                break
+            if not command[end].isspace():
+                raise _unexpected(command, "alphanumeric, underscore or whitespace", 'VALUE', command[end])
             arguments[key] = value
-    else:
-        raise ParseException(command, "command", f"invalid end state {_get_state_name(state)}")
+            i = end + 1
+        else:
+            raise _unexpected(command, "alphanumeric, underscore, whitespace or quote", 'EXPECT_VALUE', c)
 
     return Command(action, arguments)
 
 
+def _parse_quoted(command: str, i: int) -> tuple[str, int]:
+    """:return: the unescaped value starting at i and the position after the closing quote"""
+
+    length = len(command)
+    parts = []
+    while True:
+        end = _quoted_run.match(command, i).end()
+        parts.append(command[i:end])
+        if end == length:
+            raise _invalid_end(command, 'QUOTED_VALUE')
+        if command[end] == '"':
+            return ''.join(parts), end + 1
+        # an escaped character
+        if end + 1 == length:
+            raise _invalid_end(command, 'ESCAPE')
+        parts.append(command[end + 1])
+        i = end + 2
+
+
 def _is_valid_unquoted(c: str) -> bool:
     return c.isalnum() or c == '_'
 
 
-def _get_state_name(state: int) -> str:
-    return _state_name.get(state, str(state))
+def _unexpected(command: str, expected: str, state: str, c: str) -> ParseException:
+    return ParseException(command, "command", f"expected {expected} in state {state}, got '{c}'")
+
+
+def _invalid_end(command: str, state: str) -> ParseException:
+    return ParseException(command, "command", f"invalid end state {state}")
@@ -0,0 +1,49 @@
+import threading
+import time
+
+from .telegram_command import EditMessageCommand
+
+
+class EditCoalescer:
+    """Holds back message edits for a debounce window, so that only the latest edit of a message is sent
+
+    The window starts with the first held edit of a message, later edits of the same message replace it.
+
+    :parameter window: debounce window in seconds
+    """
+
+    def __init__(self, window: float):
+        self._window = window
+        self._pending: dict[tuple[str, int], tuple[float, EditMessageCommand]] = dict()
+        self._lock = threading.Lock()
+
+    def submit(self, command: EditMessageCommand):
+        key = command.key()
+        with self._lock:
+            pending = self._pending.get(key)
+            due = pending[0] if pending is not None else time.monotonic() + self._window
+            self._pending[key] = (due, command)
+
+    def discard(self, key: tuple[str, int]):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def time_to_next(self) -> float | None:
+        """Time in seconds until the next held edit is due, None if there are no held edits"""
+
+        with self._lock:
+            if len(self._pending) == 0:
+                return None
+            return max(0.0, min(due for due, _ in self._pending.values()) - time.monotonic())
+
+    def take_due(self) -> list[EditMessageCommand]:
+        now = time.monotonic()
+        with self._lock:
+            keys = [key for key, (due, _) in self._pending.items() if due <= now]
+            return [self._pending.pop(key)[1] for key in keys]
+
+    def take_all(self) -> list[EditMessageCommand]:
+        with self._lock:
+            commands = [command for _, command in self._pending.values()]
+            self._pending.clear()
+            return commands
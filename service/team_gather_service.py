@@ -1,52 +1,124 @@
+import asyncio
+import datetime
+import math
+import zoneinfo
+
 import logger
-from aws.gatherings import Gatherings, Gathering, STATE_SCHEDULED, STATE_STARTED, STATE_STOPPED
+from i18n import Catalog, get_catalog
+from aws.gatherings import Gatherings, Gathering, STATE_SCHEDULED, STATE_STARTED, STATE_STOPPED, VOTE_YES, VOTE_MAYBE, VOTE_NO
+from aws.chat_settings import ChatSettingsStore
+from aws.gathering_ids import GatheringIdAllocator
 from aws.settings import Settings
 from model.inline_keyboard import InlineKeyboard
+from telegram.api.async_telegram_api import AsyncTelegram
 from telegram.api.telegram_api import Telegram
 from telegram.model.request.edit_message import EditMessageRequest
 from telegram.model.request.get_updates import GetUpdatesRequest, TYPE_MESSAGE, TYPE_CALLBACK_QUERY
 from telegram.model.request.send_message import SendMessageRequest, MODE_HTML, InlineKeyboardMarkup
 from telegram.model.response.callback_query import CallbackQuery
 from telegram.model.response.message import Message
+from telegram.model.response.update import Update
+from .bot_identity import BotIdentity
 from .command import Command
 from .command_parser import parse as parse_command
+from .edit_coalescer import EditCoalescer
 from .parse_exception import ParseException
 from .telegram_command import SendMessageCommand, PinMessageCommand, UnpinMessageCommand, AbstractTelegramCommand, EditMessageCommand
 from .time_parser import TimeParser
 
+_poll_message_keyboards: dict[str, InlineKeyboardMarkup] = dict()
+
 
 class TeamGatherService:
-    def __init__(self, telegram: Telegram, settings: Settings, gatherings: Gatherings, i18n, time_parser: TimeParser):
+    def __init__(self, telegram: Telegram, bot_identity: BotIdentity, settings: Settings, gatherings: Gatherings, time_parser: TimeParser,
+                 gathering_ids: GatheringIdAllocator, async_telegram: AsyncTelegram = None, edit_coalescer: EditCoalescer = None, chat_settings: ChatSettingsStore = None):
         self._telegram = telegram
+        self._async_telegram = async_telegram
+        self._edit_coalescer = edit_coalescer
+        self._bot_identity = bot_identity
         self._settings = settings
         self._gatherings = gatherings
-        self._i18n = i18n
+        self._gathering_ids = gathering_ids
+        # settings of chats overriding the global ones
+        self._chat_settings = chat_settings
+        # messages of the locale of the chat being handled, see _use_chat()
+        self._i18n: Catalog = get_catalog(settings.locale)
         self._time_parser = time_parser
 
-    def handle_events(self):
-        # a deduplication mechanism not to send Telegram messages or save DynamoDB entries for the same gathering more than once
-        commands: dict[str, Command] = dict()
-        for id, gathering in self._gatherings.get_all().items():
-            command = Command()
-            command.gathering = gathering
-            commands[id] = command
+    def handle_events(self, poll_timeout: int = 0) -> int:
+        """Handle Telegram updates and time-based events
+
+        :parameter poll_timeout: long polling timeout in seconds, getUpdates returns as soon as an update arrives
+        :return: the number of updates received
+        """
+
+        # held back edits have to be sent when they are due
+        time_to_edit = self._edit_coalescer.time_to_next() if self._edit_coalescer is not None else None
+        if time_to_edit is not None:
+            poll_timeout = min(poll_timeout, math.ceil(time_to_edit))
 
-        # process Telegram updates
-        me = self._telegram.get_me()
         updates = self._telegram.get_updates(GetUpdatesRequest(
             offset=self._settings.last_update_id + 1,
+            timeout=poll_timeout,
             allowed_updates=[TYPE_MESSAGE, TYPE_CALLBACK_QUERY]
         ))
+        # the long polling request might have been waiting for a while
+        self._time_parser.refresh(int(datetime.datetime.now().timestamp()))
+        self._handle(updates, True, False)
+        return len(updates)
+
+    def handle_updates(self, updates: list[Update]):
+        """Handle Telegram updates pushed to a webhook, time-based events are not handled
+
+        Updates that were already handled (e.g. redelivered by Telegram) are skipped.
+
+        :parameter updates: the updates to handle
+        """
+
+        # nothing is kept between webhook calls
+        self._handle([update for update in updates if update.update_id > self._settings.last_update_id], False, True)
+
+    def handle_ticks(self):
+        """Handle time-based events only"""
+
+        self._handle([], True, True)
+
+    def flush_edits(self):
+        """Send all held back edits, should be called before the process may be suspended"""
+
+        self._handle([], False, True)
+
+    def _handle(self, updates: list[Update], tick: bool, flush_all_edits: bool):
+        # a deduplication mechanism not to send Telegram messages or save DynamoDB entries for the same gathering more than once
+        commands: dict[str, Command] = dict()
+
+        # commands not related to a gathering, executed before the gathering ones
+        commands_other: list[Command] = []
+
+        # settings of all the chats to handle are read at once
+        gatherings_due = self._gatherings.pop_due(self._time_parser.now()) if tick else []
+        if self._chat_settings is not None:
+            chat_ids = [gathering.chat_id for gathering in gatherings_due]
+            for update in updates:
+                if update.message is not None:
+                    chat_ids.append(update.message.chat.id)
+                elif update.callback_query is not None:
+                    chat_ids.append(update.callback_query.message.chat.id)
+            self._chat_settings.prefetch(chat_ids)
+
+        # process Telegram updates
+        prefix = self._bot_identity.command_prefix() if len(updates) != 0 else None
         for update in updates:
             command = None
             if update.message is not None:
                 message = update.message
-                prefix = '@{} '.format(me.username)
                 if message.text and message.text.startswith(prefix):
+                    self._use_chat(message.chat.id)
                     command_text = message.text.removeprefix(prefix).strip()
                     command = self._handle_command(message, command_text)
                     logger.info(f"Processed update: {command_text}; result: {command}")
             elif update.callback_query is not None:
+                self._use_chat(update.callback_query.message.chat.id)
                 command = self._handle_callback(update.callback_query)
                 logger.info(f"Processed callback: {update.callback_query}; result: {command}")
             self._settings.last_update_id = update.update_id
@@ -55,18 +127,90 @@ class TeamGatherService:
                 if command.gathering is not None:
                     commands[command.gathering.id] = command
                 else:
-                    command.execute_telegram_commands()
+                    commands_other.append(command)
+
+        # process time-based events (on a "tick") of the due gatherings and of the ones changed by the updates
+        if tick:
+            for gathering in gatherings_due:
+                if gathering.id not in commands:
+                    command = Command()
+                    command.gathering = gathering
+                    commands[gathering.id] = command
+            for id, command in commands.items():
+                self._use_chat(command.gathering.chat_id)
+                tick_command = self._handle_tick(command.gathering)
+                if tick_command is not None:
+                    commands[id] = tick_command
+                    logger.info(f"Processed tick: {command.gathering}; result: {command}")
+
+        self._execute(commands_other + list(commands.values()))
+
+        # sent edits change the fingerprint of the gathering message
+        gatherings = {command.gathering.id: command.gathering for command in commands.values()}
+        for gathering in self._flush_edits(flush_all_edits):
+            gatherings.setdefault(gathering.id, gathering)
+
+        for gathering in gatherings.values():
+            self._gatherings.save(gathering)
+
+    def _use_chat(self, chat_id: str):
+        """Use the locale and the timezone of the chat for the commands created afterwards"""
+
+        chat_settings = self._chat_settings.get(chat_id) if self._chat_settings is not None else None
+        locale = chat_settings.locale if chat_settings is not None and chat_settings.locale is not None else self._settings.locale
+        timezone = chat_settings.timezone if chat_settings is not None and chat_settings.timezone is not None else self._settings.timezone
+        self._i18n = get_catalog(locale)
+        try:
+            self._time_parser = TimeParser.for_timezone(timezone, self._time_parser.now())
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError) as e:
+            # a bad timezone of one chat must not stop the handling of the others
+            logger.warn(f"Invalid timezone {timezone} of chat {chat_id}, using {self._settings.timezone}: {e}")
+            self._time_parser = TimeParser.for_timezone(self._settings.timezone, self._time_parser.now())
+
+    def _flush_edits(self, flush_all: bool) -> list[Gathering]:
+        if self._edit_coalescer is None:
+            return []
+
+        edits = self._edit_coalescer.take_all() if flush_all else self._edit_coalescer.take_due()
+        commands = []
+        gatherings = []
+        for edit in edits:
+            command = Command()
+            if edit.gathering is None:
+                command.add_telegram_command(EditMessageCommand(self._telegram, edit.i18n, edit.edit_message_request))
+            else:
+                # the held edit shows the gathering as it was then, the state might have been reloaded or changed since
+                gathering = self._gatherings.get_all().get(edit.gathering.id)
+                if gathering is None or gathering.state != STATE_STARTED or gathering.message_id is None:
+                    logger.debug(f"Held back edit dropped, the gathering is no longer running: {edit}")
+                    continue
+                self._use_chat(gathering.chat_id)
+                command.add_telegram_command(self._new_edit_message_command(gathering, self._build_poll_message_text(gathering), self._build_poll_message_keyboard()))
+                gatherings.append(gathering)
+            commands.append(command)
+        self._execute(commands)
+
+        return gatherings
+
+    def _execute(self, commands: list[Command]):
+        if self._async_telegram is None:
+            for command in commands:
+                command.execute_telegram_commands()
+        else:
+            asyncio.run(self._execute_async(commands))
 
-        # process time-based events (on a "tick")
-        for id, command in commands.items():
-            tick_command = self._handle_tick(command.gathering)
-            if tick_command is not None:
-                commands[id] = tick_command
-                logger.info(f"Processed tick: {command.gathering}; result: {command}")
+    async def _execute_async(self, commands: list[Command]):
+        """Execute commands of different chats concurrently, commands of the same chat are executed in order"""
 
-        for command in commands.values():
-            command.execute_telegram_commands()
-            self._gatherings.save(command.gathering)
+        commands_by_chat: dict[str, list[Command]] = dict()
+        for command in commands:
+            commands_by_chat.setdefault(command.chat_id(), []).append(command)
+
+        async def execute_chat(chat_commands: list[Command]):
+            for command in chat_commands:
+                await command.execute_telegram_commands_async(self._async_telegram)
+
+        await asyncio.gather(*[execute_chat(chat_commands) for chat_commands in commands_by_chat.values()])
 
     def _handle_command(self, message: Message, text: str) -> Command:
         try:
@@ -146,7 +290,7 @@ class TeamGatherService:
             command.add_telegram_command(self._new_pin_message_command(chat_id))
 
             gathering = Gathering()
-            gathering.id = self._settings.next_gathering_id()
+            gathering.id = self._gathering_ids.next_id(int(self._settings.last_gathering_id))
             gathering.chat_id = chat_id
             gathering.state = STATE_SCHEDULED
             gathering.start = start
@@ -177,7 +321,7 @@ class TeamGatherService:
         if reply_to_message_id is None:
             command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NEED_TO_REPLY_CREATED))
         else:
-            gathering = self._gatherings.get_by_message_id(reply_to_message_id)
+            gathering = self._gatherings.get_by_message_id(chat_id, reply_to_message_id)
             if gathering is None:
                 command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NO_GATHERING))
             else:
@@ -202,7 +346,7 @@ class TeamGatherService:
         if reply_to_message_id is None:
             command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NEED_TO_REPLY_GATHERING))
         else:
-            gathering = self._gatherings.get_by_message_id(reply_to_message_id)
+            gathering = self._gatherings.get_by_message_id(chat_id, reply_to_message_id)
             if gathering is None:
                 command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NO_GATHERING))
             else:
@@ -228,7 +372,7 @@ class TeamGatherService:
         if reply_to_message_id is None:
             command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NEED_TO_REPLY_GATHERING))
         else:
-            gathering = self._gatherings.get_by_message_id(reply_to_message_id)
+            gathering = self._gatherings.get_by_message_id(chat_id, reply_to_message_id)
             if gathering is None:
                 command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NO_GATHERING))
             else:
@@ -258,7 +402,7 @@ class TeamGatherService:
         if reply_to_message_id is None:
             command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NEED_TO_REPLY_CREATED_OR_GATHERING))
         else:
-            gathering = self._gatherings.get_by_message_id(reply_to_message_id)
+            gathering = self._gatherings.get_by_message_id(chat_id, reply_to_message_id)
             if gathering is None:
                 command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NO_GATHERING))
             else:
@@ -317,7 +461,7 @@ class TeamGatherService:
                         command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NOT_EDITED.format(gathering.message_what, self._i18n.NO_EDITS)))
                     else:
                         if gathering.state == STATE_STARTED:
-                            command.add_telegram_command(self._new_edit_message_command(gathering.chat_id, gathering.message_id, self._build_poll_message_text(gathering), self._build_poll_message_keyboard()))
+                            command.add_telegram_command(self._new_edit_message_command(gathering, self._build_poll_message_text(gathering), self._build_poll_message_keyboard()))
                         command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.EDITED.format(gathering.message_what, "\n".join(edited_messages))))
                         command.gathering = gathering
                 else:
@@ -353,48 +497,35 @@ class TeamGatherService:
 
         chat_id = callback_query.message.chat.id
         message_id = callback_query.message.message_id
-        gathering = self._gatherings.get_by_message_id(message_id)
+        gathering = self._gatherings.get_by_message_id(chat_id, message_id)
         if gathering is None:
             command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.NO_GATHERING))
         elif gathering.state != STATE_STARTED:
             command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.GATHERING_NOT_RUNNING))
         else:
+            user_id = str(callback_query.from_user.id)
             name = callback_query.from_user.name()
             data = callback_query.data
             if data == 'yes':
-                if (name in gathering.participants_yes) or (len(gathering.participants_yes) >= gathering.max_count):
+                if gathering.get_vote(user_id) != VOTE_YES and gathering.count(VOTE_YES) >= gathering.max_count:
+                    command = None
+                elif not gathering.vote(user_id, name, VOTE_YES):
                     command = None
-                else:
-                    gathering.participants_yes.add(name)
-                    gathering.participants_maybe.discard(name)
-                    gathering.participants_no.discard(name)
             elif data == 'maybe':
-                if name in gathering.participants_maybe:
+                if not gathering.vote(user_id, name, VOTE_MAYBE):
                     command = None
-                else:
-                    gathering.participants_yes.discard(name)
-                    gathering.participants_maybe.add(name)
-                    gathering.participants_no.discard(name)
             elif data == 'no':
-                if name in gathering.participants_no:
+                if not gathering.vote(user_id, name, VOTE_NO):
                     command = None
-                else:
-                    gathering.participants_yes.discard(name)
-                    gathering.participants_maybe.discard(name)
-                    gathering.participants_no.add(name)
             elif data == 'remove':
-                if (name not in gathering.participants_yes) and (name not in gathering.participants_maybe) and (name not in gathering.participants_no):
+                if not gathering.unvote(user_id, name):
                     command = None
-                else:
-                    gathering.participants_yes.discard(name)
-                    gathering.participants_maybe.discard(name)
-                    gathering.participants_no.discard(name)
             else:
                 gathering = None
                 command.add_telegram_command(self._new_send_message_command(chat_id, message_id, self._i18n.UNKNOWN_COMMAND.format(data)))
 
             if command is not None and gathering is not None:
-                command.add_telegram_command(self._new_edit_message_command(gathering.chat_id, gathering.message_id, self._build_poll_message_text(gathering), self._build_poll_message_keyboard()))
+                command.add_telegram_command(self._new_edit_message_command(gathering, self._build_poll_message_text(gathering), self._build_poll_message_keyboard(), True))
                 command.gathering = gathering
 
         return command
@@ -423,11 +554,12 @@ class TeamGatherService:
     def _handle_tick_end(self, gathering: Gathering) -> Command:
         command = Command()
 
-        command.add_telegram_command(self._new_edit_message_command(gathering.chat_id, gathering.message_id, self._build_poll_message_text(gathering)))
+        command.add_telegram_command(self._new_edit_message_command(gathering, self._build_poll_message_text(gathering)))
         command.add_telegram_command(self._new_unpin_message_command(gathering.chat_id, gathering.message_id))
 
-        min_legionnaires = max(0, gathering.max_count - len(gathering.participants_yes) - len(gathering.participants_maybe))
-        max_legionnaires = gathering.max_count - len(gathering.participants_yes)
+        count_yes = gathering.count(VOTE_YES)
+        min_legionnaires = max(0, gathering.max_count - count_yes - gathering.count(VOTE_MAYBE))
+        max_legionnaires = gathering.max_count - count_yes
         if min_legionnaires == 1 and max_legionnaires == 1:
             legionnaires = self._i18n.POLL_RESULT_LEGIONNAIRES_ONE
         elif (min_legionnaires > 1 or max_legionnaires > 1) and min_legionnaires == max_legionnaires:
@@ -442,9 +574,9 @@ class TeamGatherService:
             where=self._i18n.POLL_WHERE.format(gathering.message_where) if gathering.message_where is not None else "",
             when=self._i18n.POLL_WHEN.format(gathering.message_when) if gathering.message_when is not None else "",
             max_count=gathering.max_count,
-            participants_yes=self._join_names(gathering.participants_yes),
-            participants_maybe=self._join_names(gathering.participants_maybe),
-            participants_no=self._join_names(gathering.participants_no),
+            participants_yes=self._join_names(gathering.participants(VOTE_YES)),
+            participants_maybe=self._join_names(gathering.participants(VOTE_MAYBE)),
+            participants_no=self._join_names(gathering.participants(VOTE_NO)),
             legionnaires=legionnaires
         )))
 
@@ -467,17 +599,20 @@ class TeamGatherService:
             is_updating
         )
 
-    def _new_edit_message_command(self, chat_id: str, message_id: int, text: str, reply_markup: InlineKeyboardMarkup = None) -> AbstractTelegramCommand:
+    def _new_edit_message_command(self, gathering: Gathering, text: str, reply_markup: InlineKeyboardMarkup = None, debounce: bool = False) -> AbstractTelegramCommand:
         return EditMessageCommand(
             self._telegram,
             self._i18n,
             EditMessageRequest(
-                chat_id=chat_id,
-                message_id=message_id,
+                chat_id=gathering.chat_id,
+                message_id=gathering.message_id,
                 text=text,
                 parse_mode=MODE_HTML,
                 reply_markup=reply_markup,
-            )
+            ),
+            self._edit_coalescer,
+            debounce,
+            gathering
         )
 
     def _new_pin_message_command(self, chat_id: str, message_id: int = None) -> AbstractTelegramCommand:
@@ -486,7 +621,7 @@ class TeamGatherService:
     def _new_unpin_message_command(self, chat_id: str, message_id: int) -> AbstractTelegramCommand:
         return UnpinMessageCommand(self._telegram, self._i18n, chat_id, message_id)
 
-    def _join_names(self, names: set[str]) -> str:
+    def _join_names(self, names: list[str]) -> str:
         return "\n" + "\n".join(names) if len(names) != 0 else ""
 
     def _build_poll_message_text(self, gathering: Gathering) -> str:
@@ -496,12 +631,20 @@ class TeamGatherService:
             when=self._i18n.POLL_WHEN.format(gathering.message_when) if gathering.message_when is not None else "",
             max_count=gathering.max_count,
             end=self._i18n.POLL_UNTIL.format(self._time_parser.format(gathering.end)) if gathering.end is not None else "",
-            participants_yes=self._join_names(gathering.participants_yes),
-            participants_maybe=self._join_names(gathering.participants_maybe),
-            participants_no=self._join_names(gathering.participants_no),
+            participants_yes=self._join_names(gathering.participants(VOTE_YES)),
+            participants_maybe=self._join_names(gathering.participants(VOTE_MAYBE)),
+            participants_no=self._join_names(gathering.participants(VOTE_NO)),
         )
 
     def _build_poll_message_keyboard(self) -> InlineKeyboardMarkup:
+        # the keyboard only depends on the locale
+        keyboard = _poll_message_keyboards.get(self._i18n.locale)
+        if keyboard is None:
+            keyboard = self._new_poll_message_keyboard()
+            _poll_message_keyboards[self._i18n.locale] = keyboard
+        return keyboard
+
+    def _new_poll_message_keyboard(self) -> InlineKeyboardMarkup:
         return InlineKeyboard() \
             .add_row() \
             .add_button(self._i18n.BUTTON_YES, "yes") \
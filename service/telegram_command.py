@@ -1,5 +1,8 @@
 import logger
-from telegram.api.telegram_api import Telegram
+from aws.gatherings import Gathering
+from telegram.api.async_telegram_api import AsyncTelegram
+from telegram.api.outbound_scheduler import HTTP_TOO_MANY_REQUESTS
+from telegram.api.telegram_api import Telegram, HTTP_BAD_GATEWAY, HTTP_GATEWAY_TIMEOUT
 from telegram.api.telegram_exception import TelegramException
 from telegram.model.request.edit_message import EditMessageRequest
 from telegram.model.request.pin_message import PinMessageRequest
@@ -14,37 +17,71 @@ class AbstractTelegramCommand:
     PIN = 3
     UNPIN = 4
 
-    def __init__(self, telegram: Telegram, i18n, type: int):
+    def __init__(self, telegram: Telegram, i18n, type: int, chat_id: str):
         self.telegram = telegram
         self.i18n = i18n
         self.type = type
+        self.chat_id = chat_id
         
     def _execute(self, chat_id: str, message_id: int, action):
         try:
             return action()
         except TelegramException as e:
             logger.error(f"Telegram error {e.code}: {e.body}")
+            if not self._is_reportable(e):
+                return None
+            try:
+                self.telegram.send_message(self._new_error_request(chat_id, message_id, e))
+            except TelegramException as e_nested:
+                logger.error(f"Telegram error {e_nested.code}: {e_nested.body}")
+        return None
+
+    async def _execute_async(self, telegram: AsyncTelegram, chat_id: str, message_id: int, action):
+        try:
+            return await action()
+        except TelegramException as e:
+            logger.error(f"Telegram error {e.code}: {e.body}")
+            if not self._is_reportable(e):
+                return None
             try:
-                self.telegram.send_message(SendMessageRequest(
-                    chat_id=chat_id,
-                    text=self.i18n.TELEGRAM_ERROR.format(e.code, e.description),
-                    parse_mode=MODE_HTML,
-                    reply_to_message_id=message_id
-                ))
+                await telegram.send_message(self._new_error_request(chat_id, message_id, e))
             except TelegramException as e_nested:
                 logger.error(f"Telegram error {e_nested.code}: {e_nested.body}")
         return None
 
+    def _is_reportable(self, e: TelegramException) -> bool:
+        # reporting a throttled request would only be throttled as well
+        if e.code == HTTP_TOO_MANY_REQUESTS:
+            return False
+        # Telegram could not be reached, a report would most likely fail as well
+        if e.code in (HTTP_BAD_GATEWAY, HTTP_GATEWAY_TIMEOUT):
+            return False
+        # an edit to the same content, the message is already as it should be
+        if e.description is not None and 'message is not modified' in e.description:
+            return False
+        return True
+
+    def _new_error_request(self, chat_id: str, message_id: int, e: TelegramException) -> SendMessageRequest:
+        return SendMessageRequest(
+            chat_id=chat_id,
+            text=self.i18n.TELEGRAM_ERROR.format(e.code, e.description),
+            parse_mode=MODE_HTML,
+            reply_to_message_id=message_id
+        )
+
     def execute(self):
         return None
 
+    async def execute_async(self, telegram: AsyncTelegram):
+        return None
+
     def __repr__(self) -> str:
         return f'AbstractTelegramCommand(type={self.type})'
 
 
 class SendMessageCommand(AbstractTelegramCommand):
     def __init__(self, telegram: Telegram, i18n, send_message_request: SendMessageRequest, is_updating: bool = True):
-        super().__init__(telegram, i18n, self.SEND if is_updating else self.SEND_SILENT)
+        super().__init__(telegram, i18n, self.SEND if is_updating else self.SEND_SILENT, send_message_request.chat_id)
         self.send_message_request = send_message_request
         
     def execute(self):
@@ -54,40 +91,119 @@ class SendMessageCommand(AbstractTelegramCommand):
             lambda: self.telegram.send_message(self.send_message_request)
         )
 
+    async def execute_async(self, telegram: AsyncTelegram):
+        return await super()._execute_async(
+            telegram,
+            self.send_message_request.chat_id,
+            self.send_message_request.reply_to_message_id,
+            lambda: telegram.send_message(self.send_message_request)
+        )
+
     def __repr__(self) -> str:
         return f'SendMessageCommand({self.send_message_request})'
 
 
 class EditMessageCommand(AbstractTelegramCommand):
-    def __init__(self, telegram: Telegram, i18n, edit_message_request: EditMessageRequest):
-        super().__init__(telegram, i18n, self.EDIT)
+    """Edit of a message, it may be held back by a coalescer and replaced by a later edit of the same message
+
+    :parameter coalescer: coalescer of the edits, an edit without a coalescer is always sent immediately
+    :parameter debounce: whether the edit is held back by the coalescer, otherwise it cancels a held back edit
+    :parameter gathering: gathering shown in the message, an edit that would not change the shown content is skipped
+    """
+
+    def __init__(self, telegram: Telegram, i18n, edit_message_request: EditMessageRequest, coalescer=None, debounce: bool = False,
+                 gathering: Gathering = None):
+        super().__init__(telegram, i18n, self.EDIT, edit_message_request.chat_id)
         self.edit_message_request = edit_message_request
+        self._coalescer = coalescer
+        self._debounce = debounce
+        self.gathering = gathering
+
+    def key(self) -> tuple[str, int]:
+        return self.edit_message_request.chat_id, self.edit_message_request.message_id
 
     def execute(self):
-        return super()._execute(
+        if self._hold_back():
+            return None
+        return self.send()
+
+    async def execute_async(self, telegram: AsyncTelegram):
+        if self._hold_back():
+            return None
+        return await self.send_async(telegram)
+
+    def send(self):
+        fingerprint = self.edit_message_request.fingerprint()
+        if self._is_shown(fingerprint):
+            return None
+        result = super()._execute(
             self.edit_message_request.chat_id,
             self.edit_message_request.message_id,
             lambda: self.telegram.edit_message(self.edit_message_request)
         )
+        self._on_sent(result, fingerprint)
+        return result
+
+    async def send_async(self, telegram: AsyncTelegram):
+        fingerprint = self.edit_message_request.fingerprint()
+        if self._is_shown(fingerprint):
+            return None
+        result = await super()._execute_async(
+            telegram,
+            self.edit_message_request.chat_id,
+            self.edit_message_request.message_id,
+            lambda: telegram.edit_message(self.edit_message_request)
+        )
+        self._on_sent(result, fingerprint)
+        return result
+
+    def _is_shown(self, fingerprint: str) -> bool:
+        if self.gathering is not None and self.gathering.message_hash == fingerprint:
+            logger.debug(f"Edit skipped, message content not changed: {self.edit_message_request}")
+            return True
+        return False
+
+    def _on_sent(self, result, fingerprint: str):
+        if self.gathering is not None and result is not None:
+            self.gathering.message_hash = fingerprint
+
+    def _hold_back(self) -> bool:
+        if self._coalescer is None:
+            return False
+        if self._debounce:
+            self._coalescer.submit(self)
+            return True
+        self._coalescer.discard(self.key())
+        return False
 
     def __repr__(self) -> str:
-        return f'EditMessageCommand({self.edit_message_request})'
+        return f'EditMessageCommand({self.edit_message_request}, debounce={self._debounce})'
 
 
 class PinMessageCommand(AbstractTelegramCommand):
     def __init__(self, telegram: Telegram, i18n, chat_id: str, message_id: int = None):
-        super().__init__(telegram, i18n, self.PIN)
-        self.chat_id = chat_id
+        super().__init__(telegram, i18n, self.PIN, chat_id)
         self.message_id = message_id
 
     def execute(self):
         return super()._execute(
             self.chat_id,
             self.message_id,
-            lambda: self.telegram.pin_message(PinMessageRequest(
-                chat_id=self.chat_id,
-                message_id=self.message_id
-            ))
+            lambda: self.telegram.pin_message(self._new_request())
+        )
+
+    async def execute_async(self, telegram: AsyncTelegram):
+        return await super()._execute_async(
+            telegram,
+            self.chat_id,
+            self.message_id,
+            lambda: telegram.pin_message(self._new_request())
+        )
+
+    def _new_request(self) -> PinMessageRequest:
+        return PinMessageRequest(
+            chat_id=self.chat_id,
+            message_id=self.message_id
         )
 
     def __repr__(self) -> str:
@@ -96,18 +212,28 @@ class PinMessageCommand(AbstractTelegramCommand):
 
 class UnpinMessageCommand(AbstractTelegramCommand):
     def __init__(self, telegram: Telegram, i18n, chat_id: str, message_id: int):
-        super().__init__(telegram, i18n, self.UNPIN)
-        self.chat_id = chat_id
+        super().__init__(telegram, i18n, self.UNPIN, chat_id)
         self.message_id = message_id
 
     def execute(self):
         return super()._execute(
             self.chat_id,
             self.message_id,
-            lambda: self.telegram.unpin_message(UnpinMessageRequest(
-                chat_id=self.chat_id,
-                message_id=self.message_id
-            ))
+            lambda: self.telegram.unpin_message(self._new_request())
+        )
+
+    async def execute_async(self, telegram: AsyncTelegram):
+        return await super()._execute_async(
+            telegram,
+            self.chat_id,
+            self.message_id,
+            lambda: telegram.unpin_message(self._new_request())
+        )
+
+    def _new_request(self) -> UnpinMessageRequest:
+        return UnpinMessageRequest(
+            chat_id=self.chat_id,
+            message_id=self.message_id
         )
 
     def __repr__(self) -> str:
@@ -1,13 +1,46 @@
 import datetime
+import functools
 import zoneinfo
 
 from .parse_exception import ParseException
 
 
+# time parsers by timezone name, kept between passes and warm invocations
+_time_parsers: dict[str, 'TimeParser'] = dict()
+
+
 class TimeParser:
+    """Parses and formats times in a timezone relative to the current time
+
+    Results are cached: the current date until the day changes, parsed inputs per current date and formatted timestamps.
+    """
+
+    _cache_size = 1024
+
     def __init__(self, now_timestamp: int, timezone: zoneinfo.ZoneInfo):
         self._now_timestamp = now_timestamp
         self._timezone = timezone
+        # the current date and the time range it is valid for
+        self._today: datetime.date | None = None
+        self._today_start = 0
+        self._today_end = 0
+        self._parse_datetime_cached = functools.lru_cache(maxsize=self._cache_size)(self._parse_datetime)
+        self._format_cached = functools.lru_cache(maxsize=self._cache_size)(self._format)
+
+    @staticmethod
+    def for_timezone(timezone: str, now_timestamp: int) -> 'TimeParser':
+        """:return: the time parser of the timezone, refreshed to the current time"""
+
+        time_parser = _time_parsers.get(timezone)
+        if time_parser is None:
+            time_parser = TimeParser(now_timestamp, zoneinfo.ZoneInfo(timezone))
+            _time_parsers[timezone] = time_parser
+        else:
+            time_parser.refresh(now_timestamp)
+        return time_parser
+
+    def refresh(self, now_timestamp: int):
+        self._now_timestamp = now_timestamp
 
     def now(self) -> int:
         return self._now_timestamp
@@ -16,27 +49,27 @@ class TimeParser:
         if input is None:
             return None
 
+        return self._parse_datetime_cached(input, self._get_today())
+
+    def _parse_datetime(self, input: str, today: datetime.date) -> int:
         parts = input.split('T')
         if len(parts) == 1:
-            now = self._now()
-            year, month, day = [now.year, now.month, now.day]
+            year, month, day = [today.year, today.month, today.day]
             hour, minute, second = self._parse_time(input, input)
         elif len(parts) == 2:
-            year, month, day = self._parse_date(parts[0], input)
+            year, month, day = self._parse_date(parts[0], input, today)
             hour, minute, second = self._parse_time(parts[1], input)
         else:
             raise ParseException(input, "datetime")
 
         return int(datetime.datetime(year, month, day, hour, minute, second, tzinfo=self._timezone).timestamp())
 
-    def _parse_date(self, input: str, full_input: str) -> list[int]:
+    def _parse_date(self, input: str, full_input: str, today: datetime.date) -> list[int]:
         parts = input.split('-')
         if len(parts) == 1:
-            now = self._now()
-            return [now.year, now.month, int(parts[0])]
+            return [today.year, today.month, int(parts[0])]
         elif len(parts) == 2:
-            now = self._now()
-            return [now.year, int(parts[0]), int(parts[1])]
+            return [today.year, int(parts[0]), int(parts[1])]
         elif len(parts) == 3:
             return [int(parts[0]), int(parts[1]), int(parts[2])]
         else:
@@ -53,11 +86,19 @@ class TimeParser:
         else:
             raise ParseException(full_input, "datetime")
 
-    def _localize(self, timestamp: int) -> datetime.datetime:
-        return datetime.datetime.fromtimestamp(timestamp).astimezone(self._timezone)
+    def _get_today(self) -> datetime.date:
+        if self._today is None or not self._today_start <= self._now_timestamp < self._today_end:
+            today = datetime.datetime.fromtimestamp(self._now_timestamp, self._timezone).date()
+            self._today = today
+            self._today_start = self._start_of_day(today)
+            self._today_end = self._start_of_day(today + datetime.timedelta(days=1))
+        return self._today
 
-    def _now(self) -> datetime.datetime:
-        return self._localize(self._now_timestamp)
+    def _start_of_day(self, date: datetime.date) -> int:
+        return int(datetime.datetime.combine(date, datetime.time(), tzinfo=self._timezone).timestamp())
 
     def format(self, timestamp: int) -> str:
-        return self._localize(timestamp).strftime('%Y-%m-%d %H:%M')
+        return self._format_cached(timestamp)
+
+    def _format(self, timestamp: int) -> str:
+        return datetime.datetime.fromtimestamp(timestamp, self._timezone).strftime('%Y-%m-%d %H:%M')
@@ -0,0 +1,41 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .telegram_api import Telegram
+from ..model.request.edit_message import EditMessageRequest
+from ..model.request.pin_message import PinMessageRequest
+from ..model.request.send_message import SendMessageRequest
+from ..model.request.unpin_message import UnpinMessageRequest
+from ..model.response.message import Message
+from ..model.response.response import Response
+from ..model.response.user import User
+
+
+class AsyncTelegram:
+    """Asyncio facade of the Telegram client
+
+    Calls are executed by the blocking client on a dedicated thread pool, which shares the client's
+    HTTP connection pool, so the number of workers should not exceed the connection pool size.
+    """
+
+    def __init__(self, telegram: Telegram, max_workers: int = 10):
+        self._telegram = telegram
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='telegram')
+
+    async def get_me(self) -> User:
+        return await self._call(self._telegram.get_me)
+
+    async def send_message(self, request: SendMessageRequest) -> Message:
+        return await self._call(self._telegram.send_message, request)
+
+    async def edit_message(self, request: EditMessageRequest) -> Message:
+        return await self._call(self._telegram.edit_message, request)
+
+    async def pin_message(self, request: PinMessageRequest) -> Response:
+        return await self._call(self._telegram.pin_message, request)
+
+    async def unpin_message(self, request: UnpinMessageRequest) -> Response:
+        return await self._call(self._telegram.unpin_message, request)
+
+    async def _call(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
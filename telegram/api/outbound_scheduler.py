@@ -0,0 +1,130 @@
+import math
+import threading
+import time
+
+import logger
+from .telegram_exception import TelegramException
+
+HTTP_TOO_MANY_REQUESTS = 429
+
+
+class TokenBucket:
+    """Token bucket where callers reserve tokens in advance, so that waiting callers are served in order
+
+    :parameter rate: tokens added per second
+    :parameter capacity: the maximum number of tokens, i.e. the allowed burst
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._time = time.monotonic()
+        self._blocked_until = 0.0
+
+    def reserve(self, now: float) -> float:
+        """Take a token
+
+        :return: time in seconds to wait before the token may be used
+        """
+
+        self._tokens = min(self._capacity, self._tokens + (now - self._time) * self._rate)
+        self._time = now
+        self._tokens -= 1
+        wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        return max(wait, self._blocked_until - now)
+
+    def cancel(self):
+        """Give back a token reserved and not used"""
+
+        self._tokens += 1
+
+    def is_idle(self, now: float) -> bool:
+        """:return: whether the bucket is full and not blocked, i.e. the same as a new one"""
+
+        return self._tokens + (now - self._time) * self._rate >= self._capacity and self._blocked_until <= now
+
+    def block(self, until: float):
+        self._blocked_until = max(self._blocked_until, until)
+
+
+class OutboundScheduler:
+    """Keeps outgoing chat requests within Telegram limits
+
+    Requests wait for a token from the global bucket (about 30 messages per second per bot)
+    and from the bucket of their chat (about 20 messages per minute in a group, 1 per second in a private chat).
+    A request answered with HTTP 429 blocks its chat for the 'retry_after' period and is then retried.
+
+    :parameter max_wait: the longest time in seconds a request may wait, a request that would wait longer
+        for a token or for a 'retry_after' period fails with HTTP 429
+    :parameter max_retries: how many times a throttled request is retried
+    """
+
+    # idle chat buckets are dropped this often, in seconds
+    _prune_interval = 60
+
+    def __init__(self, global_rate: float = 30, group_rate: float = 20 / 60, group_burst: float = 20,
+                 private_rate: float = 1, private_burst: float = 3, max_wait: float = 10, max_retries: int = 2):
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._group_rate = group_rate
+        self._group_burst = group_burst
+        self._private_rate = private_rate
+        self._private_burst = private_burst
+        self._max_wait = max_wait
+        self._max_retries = max_retries
+        self._chat_buckets: dict[str, TokenBucket] = dict()
+        self._pruned = time.monotonic()
+        self._lock = threading.Lock()
+
+    def call(self, chat_id: str, action):
+        attempt = 0
+        while True:
+            self._wait(chat_id)
+            try:
+                return action()
+            except TelegramException as e:
+                if e.code != HTTP_TOO_MANY_REQUESTS or attempt >= self._max_retries \
+                        or e.retry_after is None or e.retry_after > self._max_wait:
+                    raise
+                logger.warn(f"Chat {chat_id} throttled by Telegram for {e.retry_after} s")
+                with self._lock:
+                    self._chat_bucket(chat_id).block(time.monotonic() + e.retry_after)
+                attempt += 1
+
+    def _wait(self, chat_id: str):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._pruned >= self._prune_interval:
+                self._prune(now)
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = max(chat_bucket.reserve(now), self._global_bucket.reserve(now))
+            if wait > self._max_wait:
+                chat_bucket.cancel()
+                self._global_bucket.cancel()
+        if wait > self._max_wait:
+            logger.warn(f"Chat {chat_id} request dropped, it would wait for {wait:.2f} s")
+            raise TelegramException(HTTP_TOO_MANY_REQUESTS, {
+                'ok': False,
+                'description': f"Too Many Requests: request would wait for {wait:.2f} s",
+                'parameters': {'retry_after': math.ceil(wait)},
+            })
+        if wait > 0:
+            logger.debug(f"Chat {chat_id} request delayed for {wait:.2f} s")
+            time.sleep(wait)
+
+    def _prune(self, now: float):
+        # a full bucket behaves as a new one, so dropping it changes nothing
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_idle(now)]:
+            del self._chat_buckets[chat_id]
+        self._pruned = now
+
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative
+            if str(chat_id).startswith('-'):
+                bucket = TokenBucket(self._group_rate, self._group_burst)
+            else:
+                bucket = TokenBucket(self._private_rate, self._private_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
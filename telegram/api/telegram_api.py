@@ -1,6 +1,9 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 import logger
+from .outbound_scheduler import OutboundScheduler
 from .telegram_exception import TelegramException
 from ..model.request.edit_message import EditMessageRequest
 from ..model.request.get_updates import GetUpdatesRequest
@@ -13,13 +16,31 @@ from ..model.response.update import UpdateResponse, Update
 from ..model.response.user import UserResponse, User
 from ..model.util import to_json_string
 
+HTTP_BAD_GATEWAY = 502
+HTTP_GATEWAY_TIMEOUT = 504
+
 
 class Telegram:
 
     _api_url = 'https://api.telegram.org'
 
-    def __init__(self, token):
+    def __init__(self, token, pool_size: int = 10, connect_timeout: float = 5, read_timeout: float = 10, retries: int = 3,
+                 scheduler: OutboundScheduler = None):
+        self._token = token
         self._url_base = self._api_url + '/bot' + token
+        self._scheduler = scheduler
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+
+        # only failures to connect are retried: a request that reached Telegram might have been executed already
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(total=retries, connect=retries, read=0, redirect=0, status=0, other=0, backoff_factor=0.1)
+        )
+        self._session = requests.Session()
+        self._session.mount(self._api_url, adapter)
+        self._session.headers.update({'Content-Type': 'application/json'})
 
     def get_me(self) -> User:
         return self._request(
@@ -32,7 +53,7 @@ class Telegram:
     def get_updates(self, request: GetUpdatesRequest = None) -> list[Update]:
         return self._request(
             # lambda: requests.post(self._url_base + '/getUpdates', json=request.to_json()),
-            lambda: self._send_request('POST', self._url_base + '/getUpdates', body=request.to_json()),
+            lambda: self._send_request('POST', self._url_base + '/getUpdates', body=request.to_json(), long_polling_timeout=request.timeout),
             lambda v: UpdateResponse(v),
             lambda v: v.result
         )
@@ -42,41 +63,51 @@ class Telegram:
             # lambda: requests.post(self._url_base + '/sendMessage', json=request.to_json()),
             lambda: self._send_request('POST', self._url_base + '/sendMessage', body=request.to_json()),
             lambda v: MessageResponse(v),
-            lambda v: v.result
+            lambda v: v.result,
+            request.chat_id
         )
 
     def edit_message(self, request: EditMessageRequest) -> Message:
         return self._request(
             lambda: self._send_request('POST', self._url_base + '/editMessageText', body=request.to_json()),
             lambda v: MessageResponse(v),
-            lambda v: v.result
+            lambda v: v.result,
+            request.chat_id
         )
 
     def pin_message(self, request: PinMessageRequest) -> Response:
         return self._request(
             lambda: self._send_request('POST', self._url_base + '/pinChatMessage', body=request.to_json()),
             lambda v: Response(v),
-            lambda v: v
+            lambda v: v,
+            request.chat_id
         )
 
     def unpin_message(self, request: UnpinMessageRequest) -> Response:
         return self._request(
             lambda: self._send_request('POST', self._url_base + '/unpinChatMessage', body=request.to_json()),
             lambda v: Response(v),
-            lambda v: v
+            lambda v: v,
+            request.chat_id
         )
 
-    def _send_request(self, method: str, url: str, body: dict = None) -> requests.Response:
+    def _send_request(self, method: str, url: str, body: dict = None, long_polling_timeout: int = None) -> requests.Response:
         logger.debug("--> {} {}".format(method, url))
         if body:
             logger.debug(to_json_string(body))
 
-        response = requests.request(
-            method,
-            url,
-            headers={'Content-Type': 'application/json'},
-            data=to_json_string(body) if body is not None else None
-        )
+        # a failed request is reported as an HTTP error, so that it is handled as one instead of aborting the pass
+        try:
+            response = self._session.request(
+                method,
+                url,
+                data=to_json_string(body) if body is not None else None,
+                timeout=(self._connect_timeout, self._read_timeout + (long_polling_timeout or 0))
+            )
+        except requests.Timeout as e:
+            raise self._new_request_exception(HTTP_GATEWAY_TIMEOUT, e)
+        except requests.RequestException as e:
+            raise self._new_request_exception(HTTP_BAD_GATEWAY, e)
 
         logger.debug("<-- HTTP {}".format(response.status_code))
         text = response.text
@@ -85,7 +116,17 @@ class Telegram:
 
         return response
 
-    def _request(self, requestor, response_builder, result_builder):
+    def _new_request_exception(self, status_code: int, e: requests.RequestException) -> TelegramException:
+        # the URL in the message contains the token
+        description = str(e).replace(self._token, '<token>')
+        return TelegramException(status_code, {'ok': False, 'error_code': status_code, 'description': description})
+
+    def _request(self, requestor, response_builder, result_builder, chat_id: str = None):
+        if self._scheduler is not None and chat_id is not None:
+            return self._scheduler.call(chat_id, lambda: self._request_now(requestor, response_builder, result_builder))
+        return self._request_now(requestor, response_builder, result_builder)
+
+    def _request_now(self, requestor, response_builder, result_builder):
         api_response = requestor()
         json = api_response.json()
         response = response_builder(json)
@@ -5,6 +5,7 @@ class TelegramException(Exception):
     def __init__(self, status_code: int, json: dict):
         self.code = status_code
         self.description = json.get('description')
+        self.retry_after = (json.get('parameters') or {}).get('retry_after')
         self.body = to_json_string(json)
 
         super().__init__(f"HTTP {self.code}: {self.description}")
@@ -1,3 +1,3 @@
 class _AbstractModel:
     def to_json(self) -> dict:
-        return self.__dict__
+        return dict(self.__dict__)
@@ -1,6 +1,6 @@
 from .abstract_model import _AbstractModel
 from .send_message import InlineKeyboardMarkup
-from ..util import if_not_none
+from ..util import if_not_none, fingerprint
 
 
 class EditMessageRequest(_AbstractModel):
@@ -16,6 +16,9 @@ class EditMessageRequest(_AbstractModel):
         json['reply_markup'] = if_not_none(self.reply_markup, lambda v: v.to_json())
         return json
 
+    def fingerprint(self) -> str:
+        return fingerprint(self.text, self.parse_mode, if_not_none(self.reply_markup, lambda v: v.to_json()))
+
     def __repr__(self) -> str:
         reply_markup = '<reply markup>' if self.reply_markup is not None else 'None'
         return f'EditMessageRequest(chat_id={self.chat_id}, message_id={self.message_id}, parse_mode={self.parse_mode}, reply_markup={reply_markup})'
@@ -5,9 +5,11 @@ TYPE_CALLBACK_QUERY = 'callback_query'
 
 
 class GetUpdatesRequest(_AbstractModel):
-    def __init__(self, offset: int = None, allowed_updates: list[str] = None):
+    def __init__(self, offset: int = None, limit: int = None, timeout: int = None, allowed_updates: list[str] = None):
         self.offset = offset
+        self.limit = limit
+        self.timeout = timeout
         self.allowed_updates = allowed_updates
 
     def __repr__(self) -> str:
-        return f'GetUpdatesRequest(offset={self.offset}, allowed_updates={self.allowed_updates})'
+        return f'GetUpdatesRequest(offset={self.offset}, limit={self.limit}, timeout={self.timeout}, allowed_updates={self.allowed_updates})'
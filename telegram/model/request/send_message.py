@@ -1,5 +1,5 @@
 from .abstract_model import _AbstractModel
-from ..util import if_not_none
+from ..util import if_not_none, fingerprint
 
 
 MODE_MARKDOWN = 'MarkdownV2'
@@ -19,6 +19,9 @@ class SendMessageRequest(_AbstractModel):
         json['reply_markup'] = if_not_none(self.reply_markup, lambda v: v.to_json())
         return json
 
+    def fingerprint(self) -> str:
+        return fingerprint(self.text, self.parse_mode, if_not_none(self.reply_markup, lambda v: v.to_json()))
+
     def __repr__(self) -> str:
         reply_markup = '<reply markup>' if self.reply_markup is not None else 'None'
         return f'SendMessageRequest(chat_id={self.chat_id}, parse_mode={self.parse_mode}, reply_markup={reply_markup}, reply_to_message_id={self.reply_to_message_id})'
@@ -1,3 +1,4 @@
+import hashlib
 import json
 
 
@@ -7,3 +8,9 @@ def if_not_none(value, converter):
 
 def to_json_string(value: dict) -> str:
     return json.dumps({k: v for k, v in value.items() if v is not None})
+
+
+def fingerprint(text: str, parse_mode: str, reply_markup: dict | None) -> str:
+    """Hash of the visible message content"""
+
+    return hashlib.sha1(json.dumps([text, parse_mode, reply_markup]).encode()).hexdigest()